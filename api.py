@@ -0,0 +1,222 @@
+import gzip
+import http.client
+import json
+import logging
+import random
+import threading
+import time
+import urllib.parse
+
+import ratelimit
+
+API_URL = 'https://www.googleapis.com/youtube/v3/'
+USER_AGENT = 'yt-music-dl (gzip)'  # Google only compresses responses if the user agent contains "gzip"
+TIMEOUT = 30
+
+# Errors that go away by themselves if we wait a bit
+RETRY_CODES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+QUOTA_REASONS = {'quotaExceeded', 'dailyLimitExceeded'}
+
+
+class HTTPError(Exception):
+    def __init__(self, method, url, code, body, headers=None):
+        super().__init__('{} {} returned HTTP {}'.format(method, url.split('?')[0], code))
+        self.code = code
+        self.body = body
+        self.headers = headers
+
+    def json(self):
+        try:
+            return json.loads(self.body.decode('utf-8'))
+        except ValueError:
+            return None
+
+    def reason(self):
+        # The YouTube Data API explains errors like {"error": {"errors": [{"reason": "quotaExceeded"}]}}
+        try:
+            return self.json()['error']['errors'][0]['reason']
+        except (KeyError, IndexError, TypeError):
+            return None
+
+    def retry_after(self):
+        try:
+            return float(self.headers.get('Retry-After'))
+        except (AttributeError, TypeError, ValueError):
+            return None
+
+
+class Response:
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body.decode('utf-8'))
+
+
+class ConnectionPool:
+    def __init__(self):
+        # Idle keep-alive connections, per (scheme, host)
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, scheme, host):
+        with self.lock:
+            connections = self.idle.get((scheme, host))
+            if connections:
+                return connections.pop()
+
+        # No idle connection available, open a new one
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, timeout=TIMEOUT)
+        return http.client.HTTPConnection(host, timeout=TIMEOUT)
+
+    def put(self, scheme, host, conn):
+        with self.lock:
+            self.idle.setdefault((scheme, host), []).append(conn)
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for conn in connections:
+                    conn.close()
+            self.idle = {}
+
+
+# All requests share the same pool, so every host only costs us a TLS handshake per concurrent worker
+pool = ConnectionPool()
+
+
+def request(method, url, params=None, data=None, headers=None):
+    # Encode and parse parameters into URL
+    if params:
+        url = url + '?' + urllib.parse.urlencode(params)
+
+    # Form data is sent url-encoded, like the OAuth endpoints expect
+    body = None
+    request_headers = {
+        'User-Agent': USER_AGENT,
+        'Accept-Encoding': 'gzip'
+    }
+    if data is not None:
+        body = urllib.parse.urlencode(data).encode('ascii')
+        request_headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    if headers:
+        request_headers.update(headers)
+
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path + ('?' + parts.query if parts.query else '')
+
+    # A pooled connection may have been closed by the server while idle, in that case try once more
+    for attempt in range(2):
+        conn = pool.get(parts.scheme, parts.netloc)
+        try:
+            conn.request(method, path, body, request_headers)
+            response = conn.getresponse()
+            content = response.read()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError,
+                http.client.CannotSendRequest, http.client.BadStatusLine):
+            conn.close()
+            if attempt == 0:
+                logging.debug('Connection to {} was closed, reconnecting'.format(parts.netloc))
+                continue
+            raise
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            raise
+
+        # Only reuse the connection if the server wants to keep it open
+        if response.will_close:
+            conn.close()
+        else:
+            pool.put(parts.scheme, parts.netloc, conn)
+        break
+
+    # Decompress the response body if needed
+    if response.getheader('Content-Encoding', '').lower() == 'gzip':
+        content = gzip.decompress(content)
+
+    if response.status >= 400:
+        raise HTTPError(method, url, response.status, content, response.headers)
+
+    return Response(response.status, response.headers, content)
+
+
+class ApiClient:
+    def __init__(self, oauth, limiter=None, quota=None, max_retries=5):
+        self.oauth = oauth
+        self.limiter = limiter
+        self.quota = quota
+        self.max_retries = max_retries
+        self.lock = threading.Lock()
+
+    def authorization_header(self):
+        credentials = self.oauth.credentials
+        return {'Authorization': credentials['token_type'] + ' ' + credentials['access_token']}
+
+    def call(self, method, resource, params=None, headers=None):
+        cost = ratelimit.COSTS.get((method, resource), ratelimit.DEFAULT_COST)
+
+        for attempt in range(self.max_retries + 1):
+            # Pace requests, and don't send any we can't pay for
+            if self.limiter is not None:
+                self.limiter.take()
+            if self.quota is not None:
+                self.quota.spend(cost)
+
+            try:
+                response = self.send(method, resource, params, headers)
+            except HTTPError as e:
+                reason = e.reason()
+                if reason in QUOTA_REASONS:
+                    if self.quota is not None:
+                        self.quota.exhaust()
+                    raise ratelimit.QuotaExceeded('API quota is used up: ' + reason)
+
+                # Anything other than throttling or a server error won't be fixed by trying again
+                if (e.code not in RETRY_CODES and reason not in RATE_LIMIT_REASONS) or attempt == self.max_retries:
+                    raise
+                if self.limiter is not None and (e.code == 429 or reason in RATE_LIMIT_REASONS):
+                    self.limiter.slow_down()
+                delay = e.retry_after() or 2 ** attempt + random.random()
+                error = str(e)
+            except (OSError, http.client.HTTPException) as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = 2 ** attempt + random.random()
+                error = repr(e)
+            else:
+                if self.limiter is not None:
+                    self.limiter.speed_up()
+                return response
+
+            # Exponential backoff with jitter, so concurrent workers don't retry in lockstep
+            logging.debug('{}, retrying in {:.1f} seconds'.format(error, delay))
+            time.sleep(delay)
+
+    def send(self, method, resource, params=None, headers=None):
+        url = API_URL + resource
+
+        # Refresh the access token beforehand if it is about to expire
+        with self.lock:
+            self.oauth.ensure_fresh()
+
+        header = self.authorization_header()
+        try:
+            return request(method, url, params=params, headers=dict(headers or {}, **header))
+        except HTTPError as e:
+            if e.code != 401:
+                raise
+            error = e
+
+        # The access token was rejected, get a new one unless another worker already did
+        with self.lock:
+            if self.authorization_header() == header:
+                logging.debug('Access token was rejected, reauthorizing')
+                if not self.oauth.authorize_credentials(verify=True):
+                    raise error
+
+        # Retry request with new access token
+        return request(method, url, params=params, headers=dict(headers or {}, **self.authorization_header()))
@@ -0,0 +1,100 @@
+import concurrent.futures
+import http.client
+import io
+import logging
+import os
+import urllib.request
+
+import filecache
+
+TIMEOUT = 10
+
+# Art that hasn't been used for this long is removed from the cache
+MAX_AGE = 30 * 24 * 3600
+
+# Quality of the recompressed art, the thumbnails YouTube serves are larger than they need to be
+JPEG_QUALITY = 85
+
+
+def pick_thumbnail(thumbnails, size):
+    # Get the URL of the smallest thumbnail that is at least as wide as the art, or else the biggest one
+    candidates = sorted(
+        (thumbnail for thumbnail in (thumbnails or {}).values() if thumbnail.get('url')),
+        key=lambda thumbnail: thumbnail.get('width') or 0
+    )
+    for thumbnail in candidates:
+        if (thumbnail.get('width') or 0) >= size:
+            return thumbnail['url']
+    return candidates[-1]['url'] if candidates else None
+
+
+def resize(data, size):
+    # Pillow is optional, without it the thumbnail is used the way YouTube serves it
+    try:
+        from PIL import Image
+    except ImportError:
+        return data
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        image = image.convert('RGB')
+        image.thumbnail((size, size))
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+    except (OSError, ValueError):
+        logging.debug('Could not resize album art', exc_info=True)
+        return data
+
+    return output.getvalue()
+
+
+class ArtCache(filecache.FileCache):
+    def __init__(self, directory, size, workers=4):
+        # Art is downloaded in the background while the audio is, and kept resized on disk
+        # Videos often share a thumbnail URL with earlier runs, those don't have to be downloaded again
+        super().__init__(directory, 'album art')
+        self.size = size
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+
+    def get_path(self, url):
+        return super().get_path(url, '.img')
+
+    def fetch(self, url):
+        # Start getting the art, the result is picked up when the track is tagged
+        return self.executor.submit(self.get, url)
+
+    def get(self, url):
+        if self.directory is not None:
+            path = self.get_path(url)
+            try:
+                with open(path, 'rb') as file:
+                    data = file.read()
+                os.utime(path)
+                return data
+            except OSError:
+                pass
+
+        try:
+            with urllib.request.urlopen(url, timeout=TIMEOUT) as response:
+                data = response.read()
+        except (OSError, http.client.HTTPException):
+            logging.warning('Could not download album art from ' + url)
+            logging.debug('', exc_info=True)
+            return None
+
+        data = resize(data, self.size)
+
+        if self.directory is not None:
+            try:
+                self.write(path, data)
+            except OSError:
+                logging.debug('Could not cache album art', exc_info=True)
+
+        return data
+
+    def prune(self):
+        # Art is touched whenever it is used, so this only removes art of videos that are long gone
+        super().prune(MAX_AGE)
+
+    def close(self):
+        self.executor.shutdown()
@@ -0,0 +1,95 @@
+import glob
+import json
+import logging
+import os
+import threading
+
+import filecache
+import fileops
+
+
+class AudioCache(filecache.FileCache):
+    def __init__(self, directory, max_size):
+        # Converted audio is kept by video and encoder settings, so a video that shows up again
+        # in another playlist or a later run doesn't have to be downloaded and converted again
+        # The least recently used files are removed once the cache grows beyond max_size bytes, 0 turns it off
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+        if max_size <= 0:
+            self.directory = None
+            return
+
+        super().__init__(directory, 'audio')
+
+    def get_key(self, video_id, settings):
+        # The same video converted with other settings is different audio, so the settings are part of the key
+        return json.dumps([video_id, settings])
+
+    def get(self, key):
+        # Path of the cached audio, or None if it isn't cached
+        if self.directory is None:
+            return None
+
+        # The extension depends on the codec, which isn't always known up front
+        for path in glob.glob(self.get_path(key, '.*')):
+            if path.endswith('.part'):
+                continue
+            try:
+                # Using a file makes it the most recently used one
+                os.utime(path)
+                return path
+            except OSError:
+                pass
+        return None
+
+    def copy_to(self, key, dst_base):
+        # Copy cached audio to dst_base plus its extension, tagging changes the file so it can't be shared
+        path = self.get(key)
+        if path is None:
+            return None
+
+        dst_path = dst_base + os.path.splitext(path)[1]
+        try:
+            return fileops.copy_file(path, dst_path)
+        except OSError:
+            logging.debug('Could not copy audio from cache', exc_info=True)
+            return None
+
+    def put(self, key, path):
+        if self.directory is None:
+            return
+
+        # Copy under a temporary name first, so other threads never pick up half a file
+        cache_path = self.get_path(key, os.path.splitext(path)[1])
+        try:
+            fileops.copy_file(path, cache_path)
+        except OSError:
+            logging.debug('Could not cache converted audio', exc_info=True)
+            return
+
+        self.evict()
+
+    def evict(self):
+        # Remove the least recently used files until the cache fits in its size again
+        with self.lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                try:
+                    if entry.is_file() and not entry.name.endswith('.part'):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+                except OSError:
+                    pass
+
+            size = sum(entry[1] for entry in entries)
+            for mtime, file_size, path in sorted(entries):
+                if size <= self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                    size -= file_size
+                except FileNotFoundError:
+                    size -= file_size
+                except OSError:
+                    logging.debug('Could not remove file from audio cache', exc_info=True)
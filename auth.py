@@ -1,15 +1,17 @@
-import httplib2
 import json
 import logging
 import os
 import sys
 import time
-import urllib.parse
-import urllib.request
-import urllib.error
 
+import api
 import util
 
+# OAuth endpoints, these can be pointed elsewhere for testing
+TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v3/tokeninfo'
+TOKEN_URL = 'https://accounts.google.com/o/oauth2/token'
+DEVICE_CODE_URL = 'https://accounts.google.com/o/oauth2/device/code'
+
 
 class OAuth:
     def __init__(self, client_id, client_secret, credentials_file, setup=False):
@@ -23,6 +25,7 @@ class OAuth:
         self.verification_url = None
         self.retry_interval = None
         self.max_retries = 60
+        self.expiry_margin = 300  # Seconds before expiry at which we refresh the access token
 
         # Make sure we have a valid access token to work with
         if self.authorize_credentials(setup):
@@ -40,21 +43,17 @@ class OAuth:
             return False
 
         # Declare URL to get TokenInfo
-        url = 'https://www.googleapis.com/oauth2/v3/tokeninfo'
+        url = TOKENINFO_URL
 
         # Supply the access token we have to check validity
         params = {
             'access_token': self.credentials['access_token']
         }
 
-        # Encode and parse data for request
-        request_data = urllib.parse.urlencode(params)
-        request_data = request_data.encode('ascii')
-
         try:
             # Request TokenInfo for current access token
-            response = urllib.request.urlopen(url, request_data)
-        except urllib.error.HTTPError as e:
+            data = api.request('POST', url, data=params).json()
+        except api.HTTPError as e:
             # If access token is invalid, a HTML code 400 is returned
             if e.code == 400:
                 logging.debug('Access token: invalid')
@@ -64,23 +63,32 @@ class OAuth:
                 sys.exit()
 
         try:
-            # Decode and parse json response
-            str_response = response.read().decode('utf-8')
-            data = json.loads(str_response)
-
             # If the returned client id matches ours, then the access token is valid
             if 'aud' in data:
                 if data['aud'] == self.client_id:
                     logging.debug('Access token: valid')
+
+                    # Remember when the token expires, so we don't have to ask again next time
+                    if 'exp' in data and self.credentials.get('expires_at') is None:
+                        self.credentials['expires_at'] = int(data['exp'])
+                        self.store_credentials()
                     return True
 
             logging.debug('Access token: invalid')
             return False
-        except KeyError or TypeError:
+        except (KeyError, TypeError):
             logging.exception('Received unexpected response from API server while checking access token validity')
             sys.exit()
 
-    def authorize_credentials(self, setup=False):
+    def access_token_expiring(self):
+        # Without an expiry time we can't tell, so assume the token is still good
+        expires_at = self.credentials.get('expires_at')
+        if expires_at is None:
+            return False
+
+        return time.time() >= expires_at - self.expiry_margin
+
+    def authorize_credentials(self, setup=False, verify=False):
         # During first-time setup, get new credentials instead of looking for existing ones
         if setup:
             logging.debug('Getting new credentials...')
@@ -89,30 +97,36 @@ class OAuth:
         # Get locally stored credentials from file
         logging.debug('Getting credentials from file...')
         if self.get_credentials_from_file():
-            # If we got credentials from file, check if they are valid
-            if self.access_token_valid():
+            # Trust access tokens that haven't expired yet, only asking the server when we have to:
+            # if a request was rejected or if we don't know when the token expires
+            if not self.access_token_expiring():
+                if not verify and self.credentials.get('expires_at') is not None:
+                    logging.debug('Access token: not expired')
+                    return True
+                if self.access_token_valid():
+                    return True
+
+            # If credentials are invalid or about to expire, try to refresh them
+            # A freshly issued access token doesn't need to be checked
+            logging.debug('Refreshing credentials...')
+            if self.refresh_credentials():
                 return True
-            else:
-                # If credentials are invalid, try to refresh them
-                logging.debug('Refreshing credentials...')
-                if self.refresh_credentials():
-                    if self.access_token_valid():
-                        return True
-
-                # If access token is either invalid or we failed to refresh,
-                # get new credentials through user intervention
-                logging.debug('Getting new credentials...')
-                if self.get_new_credentials():
-                    return self.access_token_valid()
-                else:
-                    return False
+
+            # If access token is either invalid or we failed to refresh,
+            # get new credentials through user intervention
+            logging.debug('Getting new credentials...')
+            return self.get_new_credentials()
         else:
             # If we can't read any credentials from file, we need to get new ones
             logging.debug('Getting new credentials...')
-            if self.get_new_credentials():
-                return self.access_token_valid()
-            else:
-                return False
+            return self.get_new_credentials()
+
+    def ensure_fresh(self):
+        # Refresh the access token shortly before it expires, instead of waiting for a request to fail
+        if self.credentials is not None and self.access_token_expiring():
+            logging.debug('Access token is about to expire, refreshing credentials...')
+            if not self.refresh_credentials():
+                self.authorize_credentials(verify=True)
 
     def get_credentials_from_file(self):
         # Check if credentials file exists
@@ -133,10 +147,7 @@ class OAuth:
 
     def refresh_credentials(self):
         # Declare target URL
-        host = 'accounts.google.com'
-
-        # Create a httplib2 connection to the specified URL
-        conn = httplib2.HTTPSConnectionWithTimeout(host)
+        url = TOKEN_URL
 
         # Declare parameters to refresh credentials
         params = {
@@ -146,49 +157,35 @@ class OAuth:
             'grant_type': 'refresh_token'
         }
 
-        # Declare authentication header
-        headers = {
-            'Content-type': 'application/x-www-form-urlencoded'
-        }
-
-        # Add params and header to POST request
-        conn.request(
-            'POST',
-            '/o/oauth2/token',
-            urllib.parse.urlencode(params),
-            headers
-        )
-
         try:
             # Request credentials refresh
-            response = conn.getresponse()
-        except httplib2.HttpLib2Error:
+            response = api.request('POST', url, data=params)
+        except api.HTTPError:
+            # If response code is not 200, something is wrong
+            return False
+        except OSError:
             logging.debug('Received unexpected response from API server while refreshing credentials')
             return False
 
-        # Check if request was accepted
-        if response.status == 200:
-            try:
-                # Get refreshed credentials from response data
-                data = json.loads(response.read().decode('utf-8'))
-                if 'access_token' in data:
-                    self.credentials = {
-                        'access_token': data['access_token'],
-                        'expires_in': data['expires_in'],
-                        'token_type': data['token_type'],
-                        'refresh_token': self.credentials['refresh_token']
-                    }
-            except KeyError or TypeError:
-                logging.debug('Received unexpected response from API server while refreshing credentials')
-                return False
-
-            # Write new credentials to file and return success state
-            self.store_credentials()
-            return True
-        else:
-            # If response code is not 200, something is wrong
+        try:
+            # Get refreshed credentials from response data
+            data = response.json()
+            if 'access_token' in data:
+                self.credentials = {
+                    'access_token': data['access_token'],
+                    'expires_in': data['expires_in'],
+                    'expires_at': int(time.time()) + int(data['expires_in']),
+                    'token_type': data['token_type'],
+                    'refresh_token': self.credentials['refresh_token']
+                }
+        except (KeyError, TypeError, ValueError):
+            logging.debug('Received unexpected response from API server while refreshing credentials')
             return False
 
+        # Write new credentials to file and return success state
+        self.store_credentials()
+        return True
+
     def get_new_credentials(self, setup=False):
         if not setup:
             # We can't get new credentials if the user isn't manually running
@@ -206,10 +203,6 @@ class OAuth:
             'grant_type': 'http://oauth.net/grant_type/device/1.0'
         }
 
-        # Encode and parse data for request
-        params = urllib.parse.urlencode(params)
-        params = params.encode('ascii')
-
         tries = 0
         while tries <= self.max_retries:
             tries += 1
@@ -218,12 +211,15 @@ class OAuth:
                 # Poll google to get new credentials as soon as user enters code
                 # We are polling once before even showing the user the code,
                 # because we don't want to print the code if we can't access the server anyways
-                response = urllib.request.urlopen('https://accounts.google.com/o/oauth2/token', params)
-            except urllib.error.HTTPError as e:
+                data = api.request('POST', TOKEN_URL, data=params).json()
+            except api.HTTPError as e:
                 if e.code == 401:
                     logging.error('Could not get new credentials with user code, '
                                   'check if your client ID and client secret are correct in the config file')
                     return False
+                elif e.json() and e.json().get('error') == 'authorization_pending':
+                    # Newer versions of the API signal a pending authorization with an error status
+                    data = e.json()
                 else:
                     logging.exception('Could not get new credentials with user code')
                     return False
@@ -238,12 +234,10 @@ class OAuth:
                         )
                 )
 
-            # Decode and parse json response
-            str_response = response.read().decode('utf-8')
-            data = json.loads(str_response)
-
             if 'access_token' in data:
                 self.credentials = data
+                if 'expires_in' in data:
+                    self.credentials['expires_at'] = int(time.time()) + int(data['expires_in'])
                 self.store_credentials()
                 return True
             elif 'error' in data:
@@ -258,7 +252,7 @@ class OAuth:
 
     def get_user_code(self):
         # Declare URL
-        url = 'https://accounts.google.com/o/oauth2/device/code'
+        url = DEVICE_CODE_URL
 
         # Declare parameters to request user code
         params = {
@@ -266,28 +260,23 @@ class OAuth:
             'scope': self.scope
         }
 
-        # Encode and parse data for request
-        request_data = urllib.parse.urlencode(params)
-        request_data = request_data.encode('ascii')
-
         try:
             # Request auth codes
-            response = urllib.request.urlopen(url, request_data)
-        except urllib.error.HTTPError:
+            response = api.request('POST', url, data=params)
+        except api.HTTPError:
             logging.error('Could not get user code for authentication')
             return False
 
         try:
             # Decode and parse json response
-            str_response = response.read().decode('utf-8')
-            data = json.loads(str_response)
+            data = response.json()
 
             # Get data from json
             self.device_code = data['device_code']
             self.user_code = data['user_code']
             self.verification_url = data['verification_url']
             self.retry_interval = data['interval']
-        except KeyError or TypeError:
+        except (KeyError, TypeError):
             logging.exception('Received unexpected response from API server while getting user code for authentication')
             return False
 
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+# Offline benchmark for yt-music-dl
+# Runs the real main() against a local stand-in for the YouTube Data API and OAuth endpoints,
+# with a fake downloader that writes synthetic MP3 files instead of talking to YouTube
+
+import argparse
+import atexit
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_FILE = os.path.join(BENCH_DIR, 'results.jsonl')
+
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import stub_server  # noqa: E402
+
+# A single MPEG-1 Layer III frame: 128 kbps, 44.1 kHz, joint stereo, 26 ms of silence
+MP3_FRAME = b'\xff\xfb\x90\x64' + bytes(413)
+FRAMES_PER_SECOND = 44100 / 1152
+
+
+def load_main_module():
+    # The entry point has a dash in its name, so it can't be imported the usual way
+    spec = importlib.util.spec_from_file_location('yt_music_dl', os.path.join(ROOT_DIR, 'yt-music-dl.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_synthetic_mp3(path, seconds):
+    from mutagen.id3 import ID3
+
+    with open(path, 'wb') as file:
+        file.write(MP3_FRAME * int(seconds * FRAMES_PER_SECOND))
+
+    # Encoders write an ID3 header, and tagging expects one to be there
+    ID3().save(path, v2_version=3)
+
+
+def make_fake_downloader(seconds, latency):
+    def download_audio(url, out_dir, name, audio_format='bestaudio/best', retries=5, info_cache=None):
+        # Pretend to wait on the network, then produce a file that needs no conversion
+        time.sleep(latency)
+        path = os.path.join(out_dir, name + '.mp3')
+        write_synthetic_mp3(path, seconds)
+        return path, {'acodec': 'mp3'}
+
+    return download_audio
+
+
+def run_scenario(args):
+    work_dir = tempfile.mkdtemp(prefix='yt-music-dl-bench-')
+    output_dir = os.path.join(work_dir, 'output')
+
+    state = stub_server.StubState(args.items, error_rate=args.error_rate, seed=args.seed)
+
+    with stub_server.StubServer(state) as server:
+        # Point the program at the stub and at our temporary files
+        main_module = load_main_module()
+        main_module.CONFIG_FILE = os.path.join(work_dir, 'config.ini')
+        main_module.CREDENTIALS_FILE = os.path.join(work_dir, 'credentials.json')
+        main_module.STATE_FILE = os.path.join(work_dir, 'yt-music-dl.db')
+        main_module.METRICS_FILE = os.path.join(work_dir, 'yt-music-dl.metrics.jsonl')
+        main_module.LOG_FILE = os.path.join(work_dir, 'yt-music-dl.log')
+        main_module.LOCK_DIR = work_dir
+        main_module.download_audio = make_fake_downloader(args.track_seconds, args.download_latency)
+
+        main_module.api.API_URL = server.url + '/youtube/v3/'
+        main_module.auth.TOKENINFO_URL = server.url + '/oauth2/v3/tokeninfo'
+        main_module.auth.TOKEN_URL = server.url + '/o/oauth2/token'
+
+        with open(main_module.CONFIG_FILE, 'w') as file:
+            file.write('\n'.join([
+                '[GENERAL]',
+                'OutputDirectory = ' + output_dir,
+                'MonthBasedSubdir = False',
+                'PlaylistID = ' + state.playlist_id,
+                'OutputCodec = mp3',
+                'TempDirectory = ' + os.path.join(work_dir, 'temp'),
+                '',
+                '[AUTHENTICATION]',
+                'ClientID = bench-client',
+                'ClientSecret = bench-secret',
+                '',
+                '[API]',
+                'DailyQuota = 0',
+                'RequestsPerSecond = 0',
+                '',
+                '[CHANNELS]',
+                'Channel 1 = Electronic',
+                ''
+            ]))
+        os.makedirs(os.path.join(work_dir, 'temp'))
+
+        # Start with a token the stub rejects to exercise the 401 and refresh path
+        with open(main_module.CREDENTIALS_FILE, 'w') as file:
+            json.dump({
+                'access_token': 'expired-token' if args.expired_token else 'valid-token',
+                'token_type': 'Bearer',
+                'refresh_token': 'refresh-token',
+                'expires_in': 3600,
+                'expires_at': int(time.time()) + 3600
+            }, file)
+
+        sys.argv = ['yt-music-dl.py'] + (['--debug'] if args.debug else [])
+        started = time.perf_counter()
+        try:
+            main_module.main()
+        except SystemExit:
+            pass
+        elapsed = time.perf_counter() - started
+
+        # The work directory is removed below, along with the lock files
+        main_module.cleanup()
+        atexit.unregister(main_module.cleanup)
+
+    # Check that everything made it through
+    downloaded = len(os.listdir(output_dir)) if os.path.isdir(output_dir) else 0
+    summary = {}
+    if os.path.isfile(main_module.METRICS_FILE):
+        with open(main_module.METRICS_FILE) as file:
+            for line in file:
+                record = json.loads(line)
+                if record.get('type') == 'summary':
+                    summary = record
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        'scenario': scenario_name(args),
+        'items': args.items,
+        'seconds': round(elapsed, 3),
+        'tracks_per_minute': round(downloaded / (elapsed / 60), 1) if elapsed > 0 else 0,
+        'downloaded': downloaded,
+        'left_in_playlist': len(state.items),
+        'requests': state.requests,
+        'stages': summary.get('stages', {})
+    }
+
+
+def scenario_name(args):
+    name = '{}-items'.format(args.items)
+    if args.expired_token:
+        name += '-expired-token'
+    if args.error_rate:
+        name += '-errors-{}'.format(args.error_rate)
+    return name
+
+
+def get_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, stderr=subprocess.DEVNULL
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_previous_results():
+    previous = {}
+    if os.path.isfile(RESULTS_FILE):
+        with open(RESULTS_FILE) as file:
+            for line in file:
+                result = json.loads(line)
+                previous[result['scenario']] = result
+    return previous
+
+
+def init_args():
+    parser = argparse.ArgumentParser(description='Benchmark yt-music-dl against a local stand-in for the YouTube API')
+    parser.add_argument('--items', type=int, nargs='+', default=[10, 100, 1000], help='Playlist sizes to run')
+    parser.add_argument('--track-seconds', type=float, default=30, help='Length of the synthetic tracks')
+    parser.add_argument('--download-latency', type=float, default=0.05, help='Simulated download time per track')
+    parser.add_argument('--expired-token', action='store_true', help='Start with an access token the API rejects')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of deletions that fail with HTTP 503')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for error injection')
+    parser.add_argument('--save', action='store_true', help='Append results to ' + os.path.basename(RESULTS_FILE))
+    parser.add_argument('-d', '--debug', action='store_true', help='Show debug output of the program')
+    parser.add_argument('--scenario', action='store_true', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = init_args()
+
+    # Run a single scenario in this process, and report back to the parent
+    if args.scenario:
+        args.items = args.items[0]
+        print('RESULT ' + json.dumps(run_scenario(args)))
+        return
+
+    previous = load_previous_results()
+    revision = get_revision()
+
+    # Every scenario gets a fresh process, so imports, logging handlers and locks don't carry over
+    for items in args.items:
+        command = [sys.executable, os.path.abspath(__file__), '--scenario', '--items', str(items),
+                   '--track-seconds', str(args.track_seconds),
+                   '--download-latency', str(args.download_latency),
+                   '--error-rate', str(args.error_rate), '--seed', str(args.seed)]
+        if args.expired_token:
+            command.append('--expired-token')
+        if args.debug:
+            command.append('--debug')
+
+        output = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        results = [line[len('RESULT '):] for line in output.splitlines() if line.startswith('RESULT ')]
+        if not results:
+            print('{} items: scenario failed'.format(items))
+            continue
+
+        result = json.loads(results[-1])
+        result['revision'] = revision
+        result['time'] = int(time.time())
+
+        line = '{scenario}: {seconds:.2f}s, {tracks_per_minute} tracks/min, {downloaded}/{items} downloaded, ' \
+               '{left_in_playlist} left in playlist'.format(**result)
+
+        # Compare with the last saved run of the same scenario
+        before = previous.get(result['scenario'])
+        if before and before.get('seconds'):
+            change = (result['seconds'] - before['seconds']) / before['seconds'] * 100
+            line += ' ({:+.1f}% vs {})'.format(change, before.get('revision') or 'previous run')
+        print(line)
+        print('  requests: ' + ', '.join('{}={}'.format(k, v) for k, v in sorted(result['requests'].items())))
+
+        if args.save:
+            with open(RESULTS_FILE, 'a') as file:
+                file.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
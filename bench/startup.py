@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+# Startup benchmark for yt-music-dl
+# Measures how long invocations that have nothing to download take, and which imports they spend it on
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+
+# Modules that should only be imported once there is something to download or tag
+HEAVY_MODULES = ['youtube_dl', 'mutagen']
+
+
+def parse_importtime(stderr):
+    # Lines look like "import time:   self [us] | cumulative | imported package", nesting is shown by indentation
+    imports = {}
+    packages = set()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        packages.add(name.strip().split('.')[0])
+
+        # Nested imports are already counted in the cumulative time of their parent
+        if not name.startswith('  '):
+            imports[name.strip()] = int(cumulative_us)
+    return imports, packages
+
+
+def run(command):
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + command,
+        cwd=ROOT_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
+    )
+
+    # The benchmark reports how long main() took by itself, without interpreter startup and the stub server
+    main_seconds = None
+    for line in result.stdout.splitlines():
+        if line.startswith('RESULT '):
+            main_seconds = json.loads(line[len('RESULT '):])['seconds']
+
+    return time.perf_counter() - started, main_seconds, result.stderr
+
+
+def measure(name, command, repeat):
+    timings = []
+    main_timings = []
+    for _ in range(repeat):
+        seconds, main_seconds, stderr = run(command)
+        timings.append(seconds)
+        if main_seconds is not None:
+            main_timings.append(main_seconds)
+    imports, packages = parse_importtime(stderr)
+
+    # Only look at imports of the program itself and what it pulls in, not the ones of the interpreter
+    top = sorted(
+        ((module, us) for module, us in imports.items() if not module.startswith(('encodings', 'site', '_'))),
+        key=lambda item: -item[1]
+    )[:5]
+
+    return {
+        'scenario': name,
+        'seconds': round(statistics.median(timings), 3),
+        'min_seconds': round(min(timings), 3),
+        'main_seconds': round(statistics.median(main_timings), 3) if main_timings else None,
+        'import_seconds': round(sum(imports.values()) / 1e6, 3),
+        'heavy_imports': [module for module in HEAVY_MODULES if module in packages],
+        'slowest_imports': [[module, round(us / 1e6, 4)] for module, us in top]
+    }
+
+
+def init_args():
+    parser = argparse.ArgumentParser(description='Measure startup time of yt-music-dl when there is nothing to do')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of runs per scenario')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    return parser.parse_args()
+
+
+def main():
+    args = init_args()
+
+    # Parsing arguments only, and a complete run against the stub API with an empty playlist
+    scenarios = [
+        ('help', ['yt-music-dl.py', '--help']),
+        ('empty-queue', [os.path.join('bench', 'benchmark.py'), '--scenario', '--items', '0'])
+    ]
+
+    for name, command in scenarios:
+        result = measure(name, command, args.repeat)
+        if args.json:
+            print(json.dumps(result))
+            continue
+
+        line = '{scenario}: {seconds:.3f}s (best {min_seconds:.3f}s), {import_seconds:.3f}s of imports'.format(**result)
+        if result['main_seconds'] is not None:
+            line += ', {:.3f}s in main()'.format(result['main_seconds'])
+        print(line)
+        print('  heavy modules imported: ' + (', '.join(result['heavy_imports']) or 'none'))
+        print('  slowest imports: ' + ', '.join('{} {:.3f}s'.format(*item) for item in result['slowest_imports']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+import hashlib
+import http.server
+import json
+import random
+import threading
+import urllib.parse
+
+PAGE_SIZE = 50
+
+# Stand-in for a thumbnail, a JPEG header and trailer around some filler
+THUMBNAIL = b'\xff\xd8\xff\xe0' + bytes(range(256)) * 80 + b'\xff\xd9'
+
+
+class StubState:
+    def __init__(self, item_count, playlist_id='PLbenchmark', error_rate=0.0, seed=0):
+        self.playlist_id = playlist_id
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+        # Access tokens the stub accepts, the benchmark decides which one the client starts with
+        self.valid_tokens = {'valid-token'}
+        self.token_counter = 0
+
+        # Playlist content, in order
+        self.items = []
+        for i in range(item_count):
+            video_id = 'vid{:08d}'.format(i)
+            self.items.append({
+                'id': 'PLI{:08d}'.format(i),
+                'snippet': {
+                    'title': 'Artist {} - Title {}'.format(i % 37, i),
+                    'videoOwnerChannelTitle': 'Channel {}'.format(i % 5),
+                    'resourceId': {'kind': 'youtube#video', 'videoId': video_id}
+                }
+            })
+
+        # Request counters per endpoint
+        self.requests = {}
+
+    def count(self, name):
+        with self.lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+
+    def fail(self):
+        # Randomly fail requests to exercise retry paths, deterministic for a given seed
+        with self.lock:
+            return self.error_rate > 0 and self.random.random() < self.error_rate
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data, etag=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_form(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return dict(urllib.parse.parse_qsl(self.rfile.read(length).decode('ascii')))
+
+    def authorized(self):
+        header = self.headers.get('Authorization', '')
+        return header.split(' ')[-1] in self.state.valid_tokens
+
+    def add_thumbnails(self, item):
+        # Thumbnail URLs point back at the stub, which is only known once a request comes in
+        video_id = item['snippet']['resourceId']['videoId']
+        base_url = 'http://' + self.headers.get('Host') + '/vi/' + video_id + '/'
+        snippet = dict(item['snippet'], thumbnails={
+            'default': {'url': base_url + 'default.jpg', 'width': 120, 'height': 90},
+            'medium': {'url': base_url + 'mqdefault.jpg', 'width': 320, 'height': 180},
+            'high': {'url': base_url + 'hqdefault.jpg', 'width': 480, 'height': 360}
+        })
+        return dict(item, snippet=snippet)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+
+        if url.path == '/youtube/v3/playlistItems':
+            self.state.count('playlistItems.list')
+            if not self.authorized():
+                return self.send_json(401, {'error': {'code': 401}})
+            if params.get('playlistId') != self.state.playlist_id:
+                return self.send_json(404, {'error': {'code': 404}})
+
+            # Page tokens are offsets, like the real API, so deleting items while paging shifts pages
+            offset = int(params.get('pageToken') or 0)
+            size = min(int(params.get('maxResults') or 5), PAGE_SIZE)
+            with self.state.lock:
+                page = [self.add_thumbnails(item) for item in self.state.items[offset:offset + size]]
+                data = {'items': page, 'pageInfo': {'totalResults': len(self.state.items)}}
+                if offset + size < len(self.state.items):
+                    data['nextPageToken'] = str(offset + size)
+
+            # Like the real API, answer with a 304 if the client already has this version of the page
+            etag = '"' + hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()[:16] + '"'
+            if self.headers.get('If-None-Match') == etag:
+                self.state.count('playlistItems.notModified')
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            return self.send_json(200, data, etag)
+
+        if url.path.startswith('/vi/'):
+            self.state.count('thumbnails')
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(THUMBNAIL)))
+            self.end_headers()
+            self.wfile.write(THUMBNAIL)
+            return
+
+        if url.path == '/youtube/v3/videos':
+            self.state.count('videos.list')
+            if not self.authorized():
+                return self.send_json(401, {'error': {'code': 401}})
+
+            items = []
+            for video_id in params.get('id', '').split(',')[:PAGE_SIZE]:
+                items.append({
+                    'id': video_id,
+                    'snippet': {
+                        'channelTitle': 'Channel {}'.format(int(video_id[3:]) % 5),
+                        'thumbnails': {}
+                    },
+                    'contentDetails': {'duration': 'PT3M30S'}
+                })
+            return self.send_json(200, {'items': items})
+
+        self.send_json(404, {'error': {'code': 404}})
+
+    def do_DELETE(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+
+        if url.path == '/youtube/v3/playlistItems':
+            self.state.count('playlistItems.delete')
+            if not self.authorized():
+                return self.send_json(401, {'error': {'code': 401}})
+            if self.state.fail():
+                return self.send_json(503, {'error': {'code': 503, 'message': 'Backend Error'}})
+
+            with self.state.lock:
+                for i, item in enumerate(self.state.items):
+                    if item['id'] == params.get('id'):
+                        del self.state.items[i]
+                        break
+                else:
+                    return self.send_json(404, {'error': {'code': 404}})
+
+            self.send_response(204)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_json(404, {'error': {'code': 404}})
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        form = self.read_form()
+
+        if url.path == '/oauth2/v3/tokeninfo':
+            self.state.count('tokeninfo')
+            if form.get('access_token') in self.state.valid_tokens:
+                return self.send_json(200, {'aud': 'bench-client', 'expires_in': 3600})
+            return self.send_json(400, {'error': 'invalid_token'})
+
+        if url.path == '/o/oauth2/token':
+            self.state.count('token')
+            if form.get('grant_type') != 'refresh_token':
+                return self.send_json(400, {'error': 'unsupported_grant_type'})
+
+            with self.state.lock:
+                self.state.token_counter += 1
+                token = 'refreshed-token-{}'.format(self.state.token_counter)
+                self.state.valid_tokens.add(token)
+            return self.send_json(200, {'access_token': token, 'expires_in': 3600, 'token_type': 'Bearer'})
+
+        self.send_json(404, {'error': {'code': 404}})
+
+
+class StubServer:
+    def __init__(self, state):
+        handler = type('BoundStubHandler', (StubHandler,), {'state': state})
+        self.state = state
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        # Poll often, so shutting down doesn't add half a second to every scenario
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+# Title parsing benchmark for yt-music-dl
+# Parses a corpus of video titles with the compiled rules, and compares with the single regex the tagger used to have
+
+import argparse
+import os
+import re
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+CORPUS_FILE = os.path.join(BENCH_DIR, 'titles.txt')
+
+sys.path.insert(0, ROOT_DIR)
+
+import rules  # noqa: E402
+
+
+def parse_old(video_title):
+    # What get_tags used to do for every track, including compiling the expression
+    m = re.compile(r'(.*)(?:\s+-\s+)(.*)').match(video_title)
+    if m:
+        return {'artist': m.group(1), 'title': m.group(2)}
+    return None
+
+
+def time_parser(parse, titles, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for title in titles:
+            parse(title)
+    return (time.perf_counter() - started) / (rounds * len(titles))
+
+
+def init_args():
+    parser = argparse.ArgumentParser(description='Benchmark parsing of video titles into tags')
+    parser.add_argument('--corpus', default=CORPUS_FILE, help='File with one video title per line')
+    parser.add_argument('--rounds', type=int, default=200, help='Number of passes over the corpus')
+    parser.add_argument('--show', action='store_true', help='Print how every title is parsed')
+    return parser.parse_args()
+
+
+def main():
+    args = init_args()
+
+    with open(args.corpus, encoding='utf-8') as file:
+        titles = [line.strip() for line in file if line.strip()]
+
+    parser = rules.DEFAULT_PARSER
+
+    if args.show:
+        for title in titles:
+            print('{}\n  {}'.format(title, parser.parse(title)))
+        print()
+
+    # Count the titles that were tagged, and the ones that came out different from before
+    parsed = [parser.parse(title) for title in titles]
+    matched = sum(1 for parts in parsed if parts)
+    changed = sum(1 for title, parts in zip(titles, parsed) if parts != parse_old(title))
+
+    old = time_parser(parse_old, titles, args.rounds)
+    new = time_parser(parser.parse, titles, args.rounds)
+
+    print('{} titles, {} parsed, {} parsed differently than before'.format(len(titles), matched, changed))
+    print('old: {:.2f} us/title'.format(old * 1e6))
+    print('new: {:.2f} us/title'.format(new * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import concurrent.futures
+import logging
+import random
+import threading
+import time
+
+import ratelimit
+
+
+class DeleteQueue:
+    def __init__(self, track_state, delete_function, workers=4, batch_size=25, max_retries=2):
+        # The state store doubles as the persistent queue: tracks that were moved but not yet deleted
+        self.track_state = track_state
+        self.delete_function = delete_function
+        self.batch_size = max(1, batch_size)
+        self.max_retries = max_retries
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, workers),
+            thread_name_prefix='delete'
+        )
+
+        self.pending = []
+        self.queued = set()
+        self.futures = []
+        self.lock = threading.Lock()
+
+    def add(self, playlist_item_id, video_id, path):
+        with self.lock:
+            # Don't delete the same playlist item twice
+            if playlist_item_id in self.queued:
+                return
+            self.queued.add(playlist_item_id)
+            self.pending.append((playlist_item_id, video_id, path))
+
+            # Send out a batch of deletions once enough of them have piled up
+            if len(self.pending) >= self.batch_size:
+                self.submit_pending()
+
+    def add_unfinished(self, playlist_ids):
+        # Queue deletions that an earlier run didn't get to, for the playlists we hold the lock of
+        unfinished = self.track_state.pending_deletes(playlist_ids)
+        if unfinished:
+            logging.info('Found {} playlist items to delete from an earlier run'.format(len(unfinished)))
+        for playlist_item_id, video_id, path in unfinished:
+            self.add(playlist_item_id, video_id, path)
+
+    def submit_pending(self):
+        for item in self.pending:
+            self.futures.append(self.executor.submit(self.delete, *item))
+        self.pending = []
+
+    def delete(self, playlist_item_id, video_id, path):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.delete_function(playlist_item_id)
+                break
+            except ratelimit.QuotaExceeded:
+                # Retrying won't help until the quota resets, the item stays queued for a later run
+                logging.debug('No API quota left to delete playlist item, will retry later')
+                return False
+            except Exception:
+                if attempt == self.max_retries:
+                    # The item stays queued in the state store, so the next run will try again
+                    logging.exception('Could not delete playlist item, will retry next run')
+                    return False
+
+                # Exponential backoff with jitter, so concurrent workers don't retry in lockstep
+                delay = 2 ** attempt + random.random()
+                logging.debug('Could not delete playlist item, retrying in {:.1f} seconds'.format(delay))
+                time.sleep(delay)
+
+        self.track_state.mark(playlist_item_id, video_id, 'deleted', path)
+        logging.debug('Deleted playlist item')
+        return True
+
+    def flush(self):
+        # Send out everything that is left and wait for it to finish
+        with self.lock:
+            self.submit_pending()
+            futures = self.futures
+            self.futures = []
+
+        concurrent.futures.wait(futures)
+        return sum(1 for future in futures if future.result())
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown()
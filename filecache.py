@@ -0,0 +1,29 @@
+import hashlib
+import logging
+import os
+
+import fileops
+
+
+class FileCache:
+    def __init__(self, directory, description):
+        # Files in a cache directory are named after a hash of their key
+        # If the directory can't be created, the cache is turned off instead of failing the run
+        self.directory = directory
+
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError:
+            logging.exception('Could not create {} cache directory, the cache is turned off'.format(description))
+            self.directory = None
+
+    def get_path(self, key, ext=''):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest()[:16] + ext)
+
+    def write(self, path, data):
+        fileops.write_file(path, data)
+
+    def prune(self, max_age):
+        # Remove files that haven't been used in a while, so the cache doesn't keep growing with every track
+        if self.directory is not None:
+            fileops.remove_old_files(self.directory, max_age)
@@ -0,0 +1,140 @@
+import errno
+import os
+import shutil
+import tempfile
+import time
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def move_file(src_path, dst_path):
+    # On the same filesystem a rename is atomic and doesn't touch the file contents
+    try:
+        os.replace(src_path, dst_path)
+        return dst_path
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    # Across filesystems, the file has to be copied
+    copy_file(src_path, dst_path)
+
+    # Make sure the rename itself is on disk before we get rid of the source
+    sync_directory(os.path.dirname(dst_path) or '.')
+    os.remove(src_path)
+
+    return dst_path
+
+
+def copy_file(src_path, dst_path):
+    # Copy into a hidden temporary file next to the destination first,
+    # so a crash halfway never leaves a partial file under the final name
+    dst_dir = os.path.dirname(dst_path) or '.'
+    fd, temp_path = tempfile.mkstemp(dir=dst_dir, prefix='.', suffix='.part')
+    try:
+        with open(src_path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            copy_contents(src, dst)
+            dst.flush()
+            os.fsync(dst.fileno())
+
+        shutil.copymode(src_path, temp_path)
+        os.replace(temp_path, dst_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+    return dst_path
+
+
+def link_file(src_path, dst_path):
+    # A hard link gives the file another name without a second copy of its contents
+    # Link under a temporary name first, so an existing file at the destination is replaced like a move would
+    dst_dir = os.path.dirname(dst_path) or '.'
+    temp_path = os.path.join(dst_dir, '.' + os.path.basename(dst_path) + '.link')
+    try:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        os.link(src_path, temp_path)
+        os.replace(temp_path, dst_path)
+        return dst_path
+    except OSError as e:
+        # Links only work within a filesystem, and not every filesystem supports them
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP, errno.ENOTSUP):
+            raise
+
+    return copy_file(src_path, dst_path)
+
+
+def write_file(path, data):
+    # Write to a temporary file first and rename it, so other threads and processes never read half a file
+    with open(path + '.tmp', 'wb') as file:
+        file.write(data)
+    os.replace(path + '.tmp', path)
+
+
+def remove_old_files(directory, max_age):
+    # Remove the files in a directory, not the ones in its subdirectories, that weren't modified in max_age seconds
+    # Returns the number of files that were removed
+    now = time.time()
+    removed = 0
+    for entry in os.scandir(directory):
+        try:
+            if entry.is_file() and now - entry.stat().st_mtime > max_age:
+                os.remove(entry.path)
+                removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+def copy_contents(src, dst):
+    src_fd = src.fileno()
+    dst_fd = dst.fileno()
+    size = os.fstat(src_fd).st_size
+    copied = 0
+
+    # Let the kernel copy the data without passing it through user space, if it can
+    for function in (getattr(os, 'copy_file_range', None), getattr(os, 'sendfile', None)):
+        if function is None:
+            continue
+        os.lseek(dst_fd, copied, os.SEEK_SET)
+        try:
+            while copied < size:
+                if function is os.sendfile:
+                    sent = os.sendfile(dst_fd, src_fd, copied, min(CHUNK_SIZE, size - copied))
+                else:
+                    sent = function(src_fd, dst_fd, min(CHUNK_SIZE, size - copied), copied, copied)
+                if sent == 0:
+                    break
+                copied += sent
+            if copied >= size:
+                return
+        except OSError as e:
+            # Not supported for this combination of filesystems, try the next method
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP):
+                raise
+
+    # Plain buffered copy of whatever is left
+    src.seek(copied)
+    dst.seek(copied)
+    dst.truncate()
+    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+
+def sync_directory(path):
+    # Not every platform lets us open a directory, in which case there is nothing we can do
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
@@ -0,0 +1,52 @@
+import json
+import logging
+import os
+import time
+
+import filecache
+
+
+class InfoCache(filecache.FileCache):
+    def __init__(self, directory, ttl):
+        # Extracted info contains stream URLs that YouTube only keeps valid for a few hours, hence the TTL
+        super().__init__(directory, 'info')
+        self.ttl = ttl
+
+    def get_path(self, url):
+        return super().get_path(url, '.json')
+
+    def get(self, url):
+        if self.directory is None or self.ttl <= 0:
+            return None
+
+        path = self.get_path(url)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, url, info):
+        if self.directory is None or self.ttl <= 0:
+            return
+
+        try:
+            self.write(self.get_path(url), json.dumps(info).encode('utf-8'))
+        except (OSError, TypeError, ValueError):
+            logging.debug('Could not cache extracted info', exc_info=True)
+
+    def drop(self, url):
+        if self.directory is None:
+            return
+
+        try:
+            os.remove(self.get_path(url))
+        except FileNotFoundError:
+            pass
+
+    def prune(self):
+        # Entries that have expired are of no use anymore
+        super().prune(self.ttl)
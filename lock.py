@@ -0,0 +1,106 @@
+import errno
+import logging
+import os
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, fall back to checking the PID in the lock file
+    fcntl = None
+
+
+class LockFile:
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def acquire(self):
+        # Returns False if another living process holds the lock
+        if fcntl is not None:
+            return self.acquire_flock()
+        return self.acquire_pid()
+
+    def acquire_flock(self):
+        # The kernel drops the lock when the process dies, so a lock file left behind after a crash is harmless
+        file = open(self.path, 'a+')
+        try:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+                file.close()
+                raise
+            logging.debug('Lock "{}" is held by process {}'.format(os.path.basename(self.path), read_pid(file)))
+            file.close()
+            return False
+
+        # Record our PID for whoever wants to know who holds the lock
+        file.seek(0)
+        file.truncate()
+        file.write(str(os.getpid()))
+        file.flush()
+        self.file = file
+        return True
+
+    def acquire_pid(self):
+        for attempt in range(2):
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                # If the process that made the lock file is gone, the lock is stale and we can take it over
+                with open(self.path) as file:
+                    pid = read_pid(file)
+                if pid is not None and pid_alive(pid):
+                    logging.debug('Lock "{}" is held by process {}'.format(os.path.basename(self.path), pid))
+                    return False
+                logging.info('Removing stale lock file left by process {}'.format(pid))
+                os.remove(self.path)
+                continue
+
+            with os.fdopen(fd, 'w') as file:
+                file.write(str(os.getpid()))
+            self.file = True
+            return True
+
+        return False
+
+    def release(self):
+        if self.file is None:
+            return
+
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            self.file.close()
+        else:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+        self.file = None
+
+
+def read_pid(file):
+    try:
+        file.seek(0)
+        return int(file.read().strip())
+    except ValueError:
+        return None
+
+
+def pid_alive(pid):
+    # On Windows, os.kill would terminate the process instead of checking on it
+    if os.name == 'nt':
+        import ctypes
+        handle = ctypes.windll.kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return False
+        ctypes.windll.kernel32.CloseHandle(handle)
+        return True
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists, it just belongs to someone else
+        return True
+    return True
@@ -0,0 +1,129 @@
+import contextlib
+import json
+import logging
+import math
+import threading
+import time
+import uuid
+
+
+class Metrics:
+    def __init__(self, path):
+        self.path = path
+        self.run_id = uuid.uuid4().hex[:12]
+        self.started = time.time()
+        self.durations = {}
+        self.bytes = {}
+        self.tracks = 0
+        self.lock = threading.Lock()
+
+        try:
+            self.file = open(path, 'a')
+        except PermissionError:
+            logging.warning('No permission to write to metrics file, metrics will only be logged')
+            self.file = None
+
+    def write(self, record):
+        record['run'] = self.run_id
+        record['time'] = round(time.time(), 3)
+        if self.file is not None:
+            with self.lock:
+                self.file.write(json.dumps(record) + '\n')
+                self.file.flush()
+
+    def record(self, stage, seconds, track=None, size=None):
+        with self.lock:
+            self.durations.setdefault(stage, []).append(seconds)
+            if size:
+                self.bytes[stage] = self.bytes.get(stage, 0) + size
+            if stage == 'track':
+                self.tracks += 1
+
+        record = {'type': 'stage', 'stage': stage, 'seconds': round(seconds, 4)}
+        if track is not None:
+            record['track'] = track
+        if size is not None:
+            record['bytes'] = size
+        self.write(record)
+
+    def summary(self):
+        elapsed = time.time() - self.started
+        stages = {}
+
+        with self.lock:
+            for stage, durations in self.durations.items():
+                durations = sorted(durations)
+                stages[stage] = {
+                    'count': len(durations),
+                    'total': round(sum(durations), 3),
+                    'p50': round(percentile(durations, 50), 4),
+                    'p95': round(percentile(durations, 95), 4)
+                }
+                if stage in self.bytes:
+                    stages[stage]['bytes'] = self.bytes[stage]
+                    stages[stage]['mb_per_second'] = round(self.bytes[stage] / 1e6 / max(sum(durations), 1e-9), 3)
+
+            downloaded = sum(self.bytes.get(stage, 0) for stage in ('download', 'stream'))
+            return {
+                'type': 'summary',
+                'seconds': round(elapsed, 3),
+                'tracks': self.tracks,
+                'tracks_per_minute': round(self.tracks / (elapsed / 60), 3) if elapsed > 0 else 0,
+                'mb_per_second': round(downloaded / 1e6 / elapsed, 3) if elapsed > 0 else 0,
+                'stages': stages
+            }
+
+    def close(self):
+        summary = self.summary()
+        self.write(summary)
+
+        # Log a short human readable version as well, runs without any tracks are only interesting when debugging
+        log = logging.info if summary['tracks'] else logging.debug
+        log('Processed {} tracks in {:.1f} seconds ({} tracks/min, {} MB/s)'.format(
+            summary['tracks'], summary['seconds'], summary['tracks_per_minute'], summary['mb_per_second']
+        ))
+        for stage, values in sorted(summary['stages'].items()):
+            logging.debug('{}: {} times, p50 {:.3f}s, p95 {:.3f}s'.format(
+                stage, values['count'], values['p50'], values['p95']
+            ))
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def percentile(values, p):
+    # Nearest-rank percentile of a sorted list
+    if not values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return values[rank - 1]
+
+
+# Metrics of the current run, if any are being collected
+current = None
+
+
+def start(path):
+    global current
+    current = Metrics(path)
+    return current
+
+
+def finish():
+    global current
+    if current is not None:
+        current.close()
+        current = None
+
+
+@contextlib.contextmanager
+def stage(name, track=None):
+    # Time a block of code, the caller can fill in the number of bytes it handled
+    info = {'bytes': None}
+    started = time.perf_counter()
+    try:
+        yield info
+    finally:
+        if current is not None:
+            current.record(name, time.perf_counter() - started, track, info['bytes'])
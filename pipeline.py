@@ -0,0 +1,118 @@
+import concurrent.futures
+import logging
+import threading
+
+
+class Stage:
+    def __init__(self, name, function, workers):
+        # Declare accessible fields
+        self.name = name
+        self.function = function
+        self.workers = max(1, workers)
+        self.executor = None
+
+
+class Pipeline:
+    def __init__(self, stages, max_in_flight=None, on_error=None):
+        # Stages are run in order, each one receiving the return value of the previous one
+        self.stages = stages
+        for stage in self.stages:
+            stage.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=stage.workers,
+                thread_name_prefix=stage.name
+            )
+
+        # Limit the number of items in flight, so the producer can't run too far ahead of the workers
+        if max_in_flight is None:
+            max_in_flight = 2 * sum(stage.workers for stage in self.stages)
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+
+        # Called with the item and the exception when a stage fails
+        self.on_error = on_error
+
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.fatal_error = None
+
+    def submit(self, item, on_done=None):
+        # Stop accepting work once a stage has asked to exit
+        self.raise_fatal_error()
+
+        self.slots.acquire()
+        with self.condition:
+            self.in_flight += 1
+
+        try:
+            self.submit_to_stage(0, item, on_done)
+        except RuntimeError:
+            # A stage asked to exit while we were waiting for a free slot
+            self.item_done(on_done)
+            self.raise_fatal_error()
+            raise
+
+    def submit_to_stage(self, index, item, on_done=None):
+        stage = self.stages[index]
+        future = stage.executor.submit(stage.function, item)
+        future.add_done_callback(lambda f: self.stage_done(index, f, item, on_done))
+
+    def stage_done(self, index, future, item, on_done=None):
+        stage = self.stages[index]
+
+        try:
+            result = future.result()
+        except concurrent.futures.CancelledError:
+            # The pipeline was shut down before this item got its turn
+            self.item_done(on_done)
+            return
+        except (SystemExit, KeyboardInterrupt) as e:
+            # Errors that are meant to end the run are handed to the main thread
+            with self.condition:
+                if self.fatal_error is None:
+                    self.fatal_error = e
+            self.item_done(on_done)
+            return
+        except Exception as e:
+            # Any other error only affects this item, which stays in the playlist for the next run
+            logging.exception('Error in {} stage, skipping item'.format(stage.name))
+            if self.on_error is not None:
+                self.on_error(item, e)
+            self.item_done(on_done)
+            return
+
+        # A stage can return None to drop the item without it being an error
+        if result is None or index + 1 == len(self.stages) or self.fatal_error is not None:
+            self.item_done(on_done)
+        else:
+            try:
+                self.submit_to_stage(index + 1, result, on_done)
+            except RuntimeError:
+                # The next stage was shut down in the meantime
+                self.item_done(on_done)
+
+    def item_done(self, on_done=None):
+        # Let the producer know this item has left the pipeline, whichever way it went
+        if on_done is not None:
+            on_done()
+
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+        self.slots.release()
+
+    def join(self):
+        # Wait for all items to make it through the pipeline
+        with self.condition:
+            while self.in_flight > 0:
+                self.condition.wait()
+
+        for stage in self.stages:
+            stage.executor.shutdown()
+
+        self.raise_fatal_error()
+
+    def raise_fatal_error(self):
+        if self.fatal_error is not None:
+            # Drop any queued work, so we don't keep downloading while trying to exit
+            for stage in self.stages:
+                stage.executor.shutdown(wait=False, cancel_futures=True)
+            raise self.fatal_error
@@ -0,0 +1,104 @@
+import logging
+import threading
+import time
+
+# Quota cost of the API calls we make, see https://developers.google.com/youtube/v3/determine_quota_cost
+COSTS = {
+    ('GET', 'playlistItems'): 1,
+    ('GET', 'videos'): 1,
+    ('DELETE', 'playlistItems'): 50
+}
+DEFAULT_COST = 1
+
+# What a single track costs: its deletion, plus its share of the list requests, rounded up
+TRACK_COST = COSTS[('DELETE', 'playlistItems')] + 1
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        # A rate of 0 means requests aren't paced at all
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        # Wait until a request is allowed
+        while self.rate > 0:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def slow_down(self):
+        # The API asked us to back off, halve the rate for the requests that follow
+        with self.lock:
+            if self.rate > 0:
+                self.rate = max(self.max_rate / 16, self.rate / 2)
+
+    def speed_up(self):
+        # Creep back to the configured rate while requests succeed
+        with self.lock:
+            if self.rate > 0:
+                self.rate = min(self.max_rate, self.rate * 1.1)
+
+
+def quota_day(timestamp=None):
+    # The daily quota resets at midnight Pacific Time, a fixed UTC-8 is close enough for that
+    return time.strftime('%Y-%m-%d', time.gmtime((timestamp or time.time()) - 8 * 3600))
+
+
+class Quota:
+    def __init__(self, track_state, daily_limit):
+        # Units are counted in the state store, so runs on the same day add up
+        # A daily limit of 0 turns the check off, but units are still counted
+        self.track_state = track_state
+        self.daily_limit = daily_limit
+        self.run_units = 0
+        self.warned_day = None
+        self.lock = threading.Lock()
+
+    def used(self):
+        return self.track_state.get_quota_used(quota_day())
+
+    def remaining(self):
+        if not self.daily_limit:
+            return None
+        return max(0, self.daily_limit - self.used())
+
+    def spend(self, units):
+        with self.lock:
+            day = quota_day()
+            used = self.track_state.get_quota_used(day)
+            if self.daily_limit and used + units > self.daily_limit:
+                self.warn(day)
+                raise QuotaExceeded('Daily API quota of {} units is used up'.format(self.daily_limit))
+
+            self.track_state.add_quota_used(day, units)
+            self.run_units += units
+
+    def exhaust(self):
+        # The API says we're out of quota, trust that over our own count
+        with self.lock:
+            day = quota_day()
+            used = self.track_state.get_quota_used(day)
+            if self.daily_limit and used < self.daily_limit:
+                self.track_state.add_quota_used(day, self.daily_limit - used)
+            self.warn(day)
+
+    def warn(self, day):
+        # Only tell the user once a day, every request after this one would say the same
+        if self.warned_day != day:
+            self.warned_day = day
+            logging.warning('Daily API quota is used up, the remaining work is postponed until it resets')
@@ -0,0 +1,89 @@
+import re
+
+# Patterns that split a video title into its parts, tried in order
+# Named groups become tags: artist and title are required, featuring and remix are optional
+PATTERNS = [
+    r'(?P<artist>.*)\s+[-–—]\s+(?P<title>.*)'
+]
+
+# Things uploaders add to video titles that don't belong in a tag, like "(Official Video)" or "[HD]"
+NOISE = [
+    r'\s*[\(\[](?:official\s+)?(?:music\s+|lyrics?\s+|hd\s+)?(?:video|audio|visuali[sz]er|lyrics?)(?:\s+video)?(?:\s+hd)?[\)\]]',
+    r'\s*[\(\[](?:hd|hq|4k|720p|1080p|explicit|premiere|out now!*|free download)[\)\]]',
+    r'\s+(?:hd|hq)$'
+]
+
+# Featured artists, either in brackets or trailing the artist or title
+FEATURING = [
+    r'\s*[\(\[](?:feat\.?|ft\.?|featuring)\s+(?P<featuring>[^\)\]]+)[\)\]]',
+    r'\s+(?:feat\.?|ft\.?|featuring)\s+(?P<featuring>[^\(\[]+)'
+]
+
+# Remixes and edits, which stay part of the title
+REMIX = r'[\(\[](?P<remix>[^\(\)\[\]]*?\b(?:remix|edit|bootleg|rework|flip|mix|vip))[\)\]]'
+
+
+class TitleParser:
+    def __init__(self, patterns=None, noise=None):
+        # Everything is compiled once, parsing a title only runs the expressions
+        self.patterns = [re.compile(pattern, re.IGNORECASE) for pattern in (patterns or PATTERNS)]
+
+        # All noise is removed in a single pass, by combining it into one expression
+        self.noise = re.compile('|'.join('(?:{})'.format(pattern) for pattern in NOISE + (noise or [])), re.IGNORECASE)
+        self.featuring = [re.compile(pattern, re.IGNORECASE) for pattern in FEATURING]
+        self.remix = re.compile(REMIX, re.IGNORECASE)
+
+        for pattern in self.patterns:
+            if not {'artist', 'title'} <= set(pattern.groupindex):
+                raise ValueError('Title pattern "{}" needs an artist and a title group'.format(pattern.pattern))
+
+    def parse(self, video_title):
+        # Get the parts of the title as a dict, or None if no pattern matches
+        cleaned = self.noise.sub('', video_title).strip()
+
+        for pattern in self.patterns:
+            match = pattern.match(cleaned)
+            if match:
+                break
+        else:
+            return None
+
+        parts = {key: value.strip() for key, value in match.groupdict().items() if value and value.strip()}
+        if 'artist' not in parts or 'title' not in parts:
+            return None
+
+        # Featured artists can show up in either half, they are moved to the artist
+        if 'featuring' not in parts:
+            for field in ('title', 'artist'):
+                featuring = self.find_featuring(parts[field])
+                if featuring:
+                    parts[field], parts['featuring'] = featuring
+                    break
+
+        # A remix named by the pattern itself goes back into the title
+        remix = self.remix.search(parts['title'])
+        if remix:
+            parts.setdefault('remix', remix.group('remix').strip())
+        elif 'remix' in parts:
+            parts['title'] += ' (' + parts['remix'] + ')'
+
+        return parts
+
+    def find_featuring(self, text):
+        # Most titles don't feature anyone, and checking for the words first is a lot cheaper than the expressions
+        lowered = text.lower()
+        if 'feat' not in lowered and 'ft' not in lowered:
+            return None
+
+        for pattern in self.featuring:
+            match = pattern.search(text)
+            if match:
+                # Join what was before and after the match with a single space, like "Song ft. X (Remix)"
+                rest = ' '.join((text[:match.start()] + ' ' + text[match.end():]).split())
+                if rest:
+                    return rest, match.group('featuring').strip()
+        return None
+
+
+# Parser with the built-in patterns, for when the config file doesn't have any
+DEFAULT_PARSER = TitleParser()
@@ -0,0 +1,212 @@
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+# Stages a track goes through, in order
+STAGES = ['downloaded', 'converted', 'tagged', 'moved', 'deleted']
+
+
+def reached(current, stage):
+    # Check if the current stage is the given stage or any stage after it
+    if current is None:
+        return False
+    return STAGES.index(current) >= STAGES.index(stage)
+
+
+class StateStore:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+        try:
+            # The connection is shared between pipeline workers, access is serialized by our own lock
+            # Jobs for other playlists may use the same file, so wait for them instead of failing right away
+            self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS tracks ('
+                'playlist_item_id TEXT PRIMARY KEY, '
+                'video_id TEXT NOT NULL, '
+                'stage TEXT NOT NULL, '
+                'path TEXT, '
+                'updated REAL NOT NULL)'
+            )
+            self.conn.execute('CREATE INDEX IF NOT EXISTS tracks_video_id ON tracks (video_id, stage)')
+
+            # Databases from before tracks were recorded per playlist get the column added
+            columns = [row[1] for row in self.conn.execute('PRAGMA table_info(tracks)')]
+            if 'playlist_id' not in columns:
+                self.conn.execute('ALTER TABLE tracks ADD COLUMN playlist_id TEXT')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS pages ('
+                'playlist_id TEXT NOT NULL, '
+                'page_token TEXT NOT NULL, '
+                'etag TEXT NOT NULL, '
+                'body TEXT NOT NULL, '
+                'updated REAL NOT NULL, '
+                'PRIMARY KEY (playlist_id, page_token))'
+            )
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS failures ('
+                'playlist_item_id TEXT PRIMARY KEY, '
+                'attempts INTEGER NOT NULL, '
+                'failed REAL NOT NULL)'
+            )
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS library ('
+                'path TEXT PRIMARY KEY, '
+                'mtime REAL NOT NULL, '
+                'video_title TEXT NOT NULL, '
+                'channel TEXT, '
+                'tag_hash TEXT NOT NULL)'
+            )
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS quota ('
+                'day TEXT PRIMARY KEY, '
+                'units INTEGER NOT NULL)'
+            )
+            self.conn.commit()
+        except sqlite3.Error:
+            logging.exception('Could not open state database "' + os.path.basename(path) + '"')
+            sys.exit()
+
+    def get(self, playlist_item_id):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT stage, path FROM tracks WHERE playlist_item_id = ?',
+                (playlist_item_id,)
+            ).fetchone()
+
+        if row is None:
+            return None, None
+        return row
+
+    def mark(self, playlist_item_id, video_id, stage, path=None, playlist_id=None):
+        # Record that a track has completed the given stage, along with the file it produced
+        # The playlist is kept from earlier stages when it isn't given, like when the item is deleted
+        with self.lock:
+            self.conn.execute(
+                'INSERT INTO tracks (playlist_item_id, video_id, stage, path, updated, playlist_id) '
+                'VALUES (?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (playlist_item_id) DO UPDATE SET '
+                'video_id = excluded.video_id, stage = excluded.stage, path = excluded.path, '
+                'updated = excluded.updated, playlist_id = COALESCE(excluded.playlist_id, tracks.playlist_id)',
+                (playlist_item_id, video_id, stage, path, time.time(), playlist_id)
+            )
+            self.conn.commit()
+
+    def resume(self, playlist_item_id):
+        # Get the last completed stage of a track, but only if the file it produced is still there
+        stage, path = self.get(playlist_item_id)
+
+        if stage is None or stage == 'deleted':
+            return stage, path
+
+        if path is None or not os.path.isfile(path):
+            # Temporary files may have been cleaned up, or the file was removed from the library
+            logging.debug('Output of stage "{}" has gone missing, starting over'.format(stage))
+            return None, None
+
+        return stage, path
+
+    def find_in_library(self, video_id):
+        # Look up a file of this video that has already made it to the output directory
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT path FROM tracks WHERE video_id = ? AND stage IN ('moved', 'deleted')",
+                (video_id,)
+            ).fetchall()
+
+        for (path,) in rows:
+            if path and os.path.isfile(path):
+                return path
+
+        return None
+
+    def pending_deletes(self, playlist_ids):
+        # Tracks of the given playlists that made it to the library, but whose playlist item hasn't been deleted yet
+        # Other playlists may be finalizing tracks in another job, those are left to that job
+        # Tracks recorded before the playlist was kept can't belong to a running job, so those are included
+        placeholders = ', '.join('?' * len(playlist_ids))
+        with self.lock:
+            return self.conn.execute(
+                "SELECT playlist_item_id, video_id, path FROM tracks WHERE stage = 'moved' "
+                "AND (playlist_id IN ({}) OR playlist_id IS NULL) ORDER BY updated".format(placeholders),
+                list(playlist_ids)
+            ).fetchall()
+
+    def get_page(self, playlist_id, page_token):
+        # The last response we got for a page of a playlist, with its ETag
+        with self.lock:
+            return self.conn.execute(
+                'SELECT etag, body FROM pages WHERE playlist_id = ? AND page_token = ?',
+                (playlist_id, page_token or '')
+            ).fetchone()
+
+    def put_page(self, playlist_id, page_token, etag, body):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO pages (playlist_id, page_token, etag, body, updated) VALUES (?, ?, ?, ?, ?)',
+                (playlist_id, page_token or '', etag, body, time.time())
+            )
+            self.conn.commit()
+
+    def get_failure(self, playlist_item_id):
+        # How often a track has failed, and when it last did
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT attempts, failed FROM failures WHERE playlist_item_id = ?',
+                (playlist_item_id,)
+            ).fetchone()
+
+        if row is None:
+            return 0, None
+        return row
+
+    def record_failure(self, playlist_item_id):
+        with self.lock:
+            self.conn.execute('INSERT OR IGNORE INTO failures (playlist_item_id, attempts, failed) VALUES (?, 0, 0)',
+                              (playlist_item_id,))
+            self.conn.execute('UPDATE failures SET attempts = attempts + 1, failed = ? WHERE playlist_item_id = ?',
+                              (time.time(), playlist_item_id))
+            self.conn.commit()
+
+    def clear_failure(self, playlist_item_id):
+        with self.lock:
+            self.conn.execute('DELETE FROM failures WHERE playlist_item_id = ?', (playlist_item_id,))
+            self.conn.commit()
+
+    def get_quota_used(self, day):
+        with self.lock:
+            row = self.conn.execute('SELECT units FROM quota WHERE day = ?', (day,)).fetchone()
+        return row[0] if row else 0
+
+    def add_quota_used(self, day, units):
+        # Other processes may be spending quota at the same time, so add to the count instead of overwriting it
+        with self.lock:
+            self.conn.execute('INSERT OR IGNORE INTO quota (day, units) VALUES (?, 0)', (day,))
+            self.conn.execute('UPDATE quota SET units = units + ? WHERE day = ?', (units, day))
+            self.conn.commit()
+
+    def get_library_index(self):
+        # Every file in the library that has been retagged, with what it was tagged from
+        with self.lock:
+            rows = self.conn.execute('SELECT path, mtime, video_title, channel, tag_hash FROM library').fetchall()
+        return {row[0]: row[1:] for row in rows}
+
+    def update_library_index(self, entries, removed=()):
+        # Entries are (path, mtime, video_title, channel, tag_hash) tuples, all written in one transaction
+        with self.lock:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO library (path, mtime, video_title, channel, tag_hash) VALUES (?, ?, ?, ?, ?)',
+                entries
+            )
+            self.conn.executemany('DELETE FROM library WHERE path = ?', ((path,) for path in removed))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -1,38 +1,260 @@
-from mutagen.id3 import ID3, TIT2, TPE1, TCON
+import base64
 import logging
+import os
 
+# mutagen is imported where it's used, so runs that don't tag anything don't have to wait for it
 
 # Collection of fields and their corresponding ID3 frames
-# Use lowercase for field names
+# Use lowercase for field names, frames that need a description have it after a colon
 FIELDS = {
-    'title': TIT2,
-    'artist': TPE1,
-    'genre': TCON
+    'title': 'TIT2',
+    'artist': 'TPE1',
+    'genre': 'TCON',
+    'comment': 'COMM',
+    'url': 'WOAS',
+    'channel': 'TXXX:Channel'
 }
 
+# Corresponding atoms for MP4/M4A files, fields that are missing aren't written
+MP4_FIELDS = {
+    'title': '\xa9nam',
+    'artist': '\xa9ART',
+    'genre': '\xa9gen',
+    'comment': '\xa9cmt',
+    'channel': '----:com.apple.iTunes:Channel'
+}
+
+# Corresponding Vorbis comments for Ogg files
+VORBIS_FIELDS = {
+    'title': 'title',
+    'artist': 'artist',
+    'genre': 'genre',
+    'comment': 'comment',
+    'url': 'website',
+    'channel': 'channel'
+}
+
+# Room left behind an ID3 tag when it has to grow, so later changes like retagging fit in place
+# Without it, every change that makes the tag bigger moves all of the audio behind it
+ID3_PADDING = 16 * 1024
 
-def apply_tags(tags, path):
+
+def apply_tags(tags, path, art=None):
     # Make sure passed tags argument is a list
-    if type(tags) is not list:
+    if isinstance(tags, Tag):
         tags = [tags]
 
-    # Check if tags argument contains Tag objects
+    # Tags whose value is None or whitespace remove the field from the file, like a genre that no longer applies
+
+    # Pick the tag format based on the type of file
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.mp3':
+        apply_id3_tags(tags, path, art)
+    elif ext in ('.m4a', '.mp4'):
+        apply_mp4_tags(tags, path, art)
+    elif ext in ('.opus', '.ogg'):
+        apply_vorbis_tags(tags, path, art)
+    else:
+        logging.warning('Cannot tag files of type "' + ext + '"')
+
+
+def has_value(tag):
+    return tag.value is not None and not tag.value.isspace()
+
+
+def read_tags(path, fieldnames):
+    # Get the values of some fields from a file as a dict, fields that aren't there are left out
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.mp3':
+        return read_id3_tags(path, fieldnames)
+    elif ext in ('.m4a', '.mp4'):
+        return read_mp4_tags(path, fieldnames)
+    elif ext in ('.opus', '.ogg'):
+        return read_vorbis_tags(path, fieldnames)
+    return {}
+
+
+def read_id3_tags(path, fieldnames):
+    from mutagen import id3
+
+    try:
+        audio = id3.ID3(path)
+    except id3.ID3NoHeaderError:
+        return {}
+
+    values = {}
+    for fieldname in fieldnames:
+        for frame in get_id3_frames(audio, FIELDS[fieldname]):
+            if frame.FrameID.startswith('W'):
+                values[fieldname] = frame.url
+            elif frame.text:
+                values[fieldname] = str(frame.text[0])
+            break
+    return values
+
+
+def get_id3_frames(audio, frame_spec):
+    # Frames in a tag for a frame ID, with the description after the colon if there is one
+    frame_id, _, description = frame_spec.partition(':')
+    return [frame for frame in audio.getall(frame_id) if getattr(frame, 'desc', '') == description]
+
+
+def read_mp4_tags(path, fieldnames):
+    from mutagen.mp4 import MP4
+
+    audio = MP4(path)
+    values = {}
+    for fieldname in fieldnames:
+        key = MP4_FIELDS.get(fieldname)
+        if key is None or audio.tags is None or not audio.tags.get(key):
+            continue
+        value = audio.tags[key][0]
+        values[fieldname] = bytes(value).decode('utf-8', 'replace') if key.startswith('----') else value
+    return values
+
+
+def read_vorbis_tags(path, fieldnames):
+    from mutagen.oggopus import OggOpus, OggOpusHeaderError
+    from mutagen.oggvorbis import OggVorbis
+
+    try:
+        audio = OggOpus(path)
+    except OggOpusHeaderError:
+        audio = OggVorbis(path)
+
+    values = {}
+    for fieldname in fieldnames:
+        value = audio.get(VORBIS_FIELDS[fieldname])
+        if value:
+            values[fieldname] = value[0]
+    return values
+
+
+def apply_tags_to_files(jobs):
+    # Tag a batch of files, as (path, tags, art) tuples, and get the paths that could not be tagged
+    # A file that fails doesn't stop the rest of the batch
+    from mutagen import MutagenError
+
+    failed = []
+    for path, tags, art in jobs:
+        try:
+            apply_tags(tags, path, art)
+        except (MutagenError, OSError, KeyError, ValueError):
+            logging.exception('Could not tag "' + path + '"')
+            failed.append(path)
+    return failed
+
+
+def get_mime_type(art):
+    # YouTube serves thumbnails as JPEG, but art from elsewhere could be PNG
+    if art.startswith(b'\x89PNG'):
+        return 'image/png'
+    return 'image/jpeg'
+
+
+def apply_id3_tags(tags, path, art=None):
+    from mutagen import id3
+
+    # Build the complete tag in memory, on top of what is already in the file
+    # Only the tag at the start of the file is read, not the audio behind it
+    try:
+        audio = id3.ID3(path, v2_version=3)
+    except id3.ID3NoHeaderError:
+        audio = id3.ID3()
+
+    # Frames replace earlier ones with the same ID and description
     for tag in tags:
-        if type(tag) is not Tag:
-            raise ValueError('Tags argument must consist of Tag objects')
+        if has_value(tag):
+            audio.add(get_id3_frame(id3, tag))
+        else:
+            for frame in get_id3_frames(audio, tag.frame):
+                del audio[frame.HashKey]
 
-    # Create ID3 object
+    # Front cover, replacing any earlier art
+    if art:
+        audio.delall('APIC')
+        audio.add(id3.APIC(encoding=0, mime=get_mime_type(art), type=3, desc='Cover', data=art))
+
+    # Write tags to file in one go
     # We're using ID3v2.3 because some apps don't support v2.4 (such as MS File Explorer)
-    audio = ID3(path, v2_version=3)
+    audio.save(path, v2_version=3, padding=get_id3_padding)
+
+
+def get_id3_frame(id3, tag):
+    frame_id, _, description = tag.frame.partition(':')
+    frame = getattr(id3, frame_id)
+
+    if frame_id == 'COMM':
+        return frame(lang='eng', desc=description, text=tag.value)
+    if frame_id == 'TXXX':
+        return frame(desc=description, text=tag.value)
+    if frame_id.startswith('W'):
+        return frame(url=tag.value)
+    return frame(text=tag.value)
+
+
+def get_id3_padding(info):
+    # If the new tag fits in the space of the old one, keep that size so only the tag itself is written
+    if info.padding >= 0:
+        return info.padding
+    return ID3_PADDING
+
+
+def apply_mp4_tags(tags, path, art=None):
+    from mutagen.mp4 import MP4, MP4Cover
+
+    audio = MP4(path)
+    if audio.tags is None:
+        audio.add_tags()
 
-    # Add tags to ID3 object
     for tag in tags:
-        # Don't add tag if value is None or whitespace, or if no frame is specified
-        if tag.value is not None and not tag.value.isspace() and tag.frame is not None:
-            audio.add(tag.frame(text=tag.value))
+        key = MP4_FIELDS.get(tag.fieldname.lower())
+        if key is None:
+            continue
+
+        if not has_value(tag):
+            if key in audio.tags:
+                del audio.tags[key]
+        # Freeform atoms hold bytes instead of text
+        elif key.startswith('----'):
+            audio.tags[key] = [tag.value.encode('utf-8')]
+        else:
+            audio.tags[key] = [tag.value]
+
+    if art:
+        image_format = MP4Cover.FORMAT_PNG if get_mime_type(art) == 'image/png' else MP4Cover.FORMAT_JPEG
+        audio.tags['covr'] = [MP4Cover(art, imageformat=image_format)]
+
+    audio.save()
+
+
+def apply_vorbis_tags(tags, path, art=None):
+    from mutagen.flac import Picture
+    from mutagen.oggopus import OggOpus, OggOpusHeaderError
+    from mutagen.oggvorbis import OggVorbis
+
+    # Opus and Vorbis both live in an Ogg container, but need a different parser
+    try:
+        audio = OggOpus(path)
+    except OggOpusHeaderError:
+        audio = OggVorbis(path)
+
+    for tag in tags:
+        key = VORBIS_FIELDS[tag.fieldname.lower()]
+        if has_value(tag):
+            audio[key] = [tag.value]
+        elif key in audio:
+            del audio[key]
+
+    # Ogg has no picture field of its own, art goes into a comment as a base64 encoded FLAC picture block
+    if art:
+        picture = Picture()
+        picture.type = 3
+        picture.mime = get_mime_type(art)
+        picture.data = art
+        audio['metadata_block_picture'] = [base64.b64encode(picture.write()).decode('ascii')]
 
-    # Write tags to file
-    audio.save(v2_version=3)
+    audio.save()
 
 
 class Tag:
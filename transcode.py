@@ -0,0 +1,228 @@
+import http.client
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import time
+import urllib.request
+
+CHUNK_SIZE = 64 * 1024
+
+# Output codecs we can produce, with the container and encoder settings that go with them
+# The MP3 settings are the same ones youtube-dl uses for its FFmpegExtractAudio postprocessor
+CODECS = {
+    'mp3': {
+        'ext': 'mp3',
+        'format': 'mp3',
+        'options': ['-codec:a', 'libmp3lame', '-q:a', '5', '-id3v2_version', '3']
+    },
+    'aac': {
+        'ext': 'm4a',
+        'format': 'ipod',
+        'options': ['-codec:a', 'aac', '-b:a', '192k']
+    },
+    'opus': {
+        'ext': 'opus',
+        'format': 'opus',
+        'options': ['-codec:a', 'libopus', '-b:a', '128k']
+    }
+}
+
+# Output codec policies from the config file, with the audio codec they produce
+POLICIES = {
+    'mp3': 'mp3',
+    'm4a': 'aac',
+    'opus': 'opus',
+    'keep': None
+}
+
+# youtube-dl format selection per policy, preferring streams that only need to be remuxed
+FORMATS = {
+    'mp3': 'bestaudio/best',
+    'm4a': 'bestaudio[acodec^=mp4a]/bestaudio/best',
+    'opus': 'bestaudio[acodec=opus]/bestaudio/best',
+    'keep': 'bestaudio/best'
+}
+
+# Guesses for when youtube-dl didn't tell us the codec, e.g. when resuming an earlier run
+EXTENSION_CODECS = {
+    'm4a': 'aac',
+    'mp4': 'aac',
+    'webm': 'opus',
+    'opus': 'opus',
+    'ogg': 'vorbis',
+    'mp3': 'mp3'
+}
+
+
+def get_encoder():
+    # youtube-dl can work with either ffmpeg or avconv, so we do the same
+    for name in ('ffmpeg', 'avconv'):
+        path = shutil.which(name)
+        if path:
+            return path
+
+    logging.critical('Could not find ffmpeg or avconv, please install one of them')
+    sys.exit()
+
+
+def normalize_codec(acodec, path=None):
+    # youtube-dl reports codecs like "mp4a.40.2", we only care about the family
+    if acodec and acodec != 'none':
+        acodec = acodec.lower()
+        if acodec.startswith('mp4a') or acodec == 'aac':
+            return 'aac'
+        if acodec.startswith('mp3'):
+            return 'mp3'
+        return acodec.split('.')[0]
+
+    if path:
+        return EXTENSION_CODECS.get(os.path.splitext(path)[1][1:].lower())
+
+    return None
+
+
+def plan(policy, source_codec):
+    # Get the codec to produce and whether it can be copied instead of encoded
+    target = POLICIES[policy]
+
+    if target is None:
+        # Keep the original audio, but put it in a container we can tag if we know one
+        if source_codec in CODECS:
+            return source_codec, True
+        return None, True
+
+    return target, source_codec == target
+
+
+def get_options(target, copy):
+    if copy:
+        return ['-vn', '-codec:a', 'copy']
+    return ['-vn'] + CODECS[target]['options']
+
+
+def get_settings(policy):
+    # Everything that decides which audio a policy ends up with, the audio cache uses this as part of its key
+    target = POLICIES[policy]
+    return [policy, FORMATS[policy], CODECS[target] if target else None]
+
+
+def convert_audio(src_path, dst_base, policy='mp3', source_codec=None):
+    # Work out what we have and what we want
+    source_codec = normalize_codec(source_codec, src_path)
+    target, copy = plan(policy, source_codec)
+
+    # Nothing we can remux into, so keep the downloaded file exactly as it is
+    if target is None:
+        dst_path = dst_base + os.path.splitext(src_path)[1]
+        os.replace(src_path, dst_path)
+        return dst_path
+
+    dst_path = dst_base + '.' + CODECS[target]['ext']
+
+    # Nothing to do if the source is already what we want
+    if os.path.abspath(src_path) == os.path.abspath(dst_path):
+        return dst_path
+
+    command = [get_encoder(), '-y', '-loglevel', 'error', '-i', src_path] + get_options(target, copy)
+    command += ['-f', CODECS[target]['format'], dst_path]
+
+    if copy:
+        logging.debug('Source is already {}, remuxing instead of encoding'.format(target))
+
+    logging.debug('Running: ' + ' '.join(command))
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError('Conversion of "{}" failed: {}'.format(
+            os.path.basename(src_path),
+            result.stderr.decode('utf-8', 'replace').strip()
+        ))
+
+    # The source file is no longer needed
+    os.remove(src_path)
+
+    return dst_path
+
+
+def can_stream(policy, source_codec):
+    # Streaming needs a container for the encoder to write to
+    return plan(policy, normalize_codec(source_codec))[0] is not None
+
+
+def stream_audio(url, http_headers, dst_base, policy='mp3', source_codec=None, metadata=None, retries=5):
+    target, copy = plan(policy, normalize_codec(source_codec))
+    dst_path = dst_base + '.' + CODECS[target]['ext']
+
+    # Write to a temporary name, so an interrupted stream can't be mistaken for a finished file
+    part_path = dst_path + '.part'
+
+    # Read the source from stdin and write tags while encoding, so no separate tagging pass is needed
+    command = [get_encoder(), '-y', '-loglevel', 'error', '-i', 'pipe:0'] + get_options(target, copy)
+    for key, value in (metadata or {}).items():
+        command += ['-metadata', '{}={}'.format(key, value)]
+    command += ['-f', CODECS[target]['format'], part_path]
+
+    logging.debug('Running: ' + ' '.join(command))
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    # Feed the encoder as the audio comes in, so encoding happens while we're still downloading
+    received = 0
+    try:
+        for attempt in range(retries + 1):
+            # Continue where an earlier attempt stopped, without fetching the bytes we already have again
+            headers = dict(http_headers or {})
+            if received:
+                headers['Range'] = 'bytes={}-'.format(received)
+
+            try:
+                request = urllib.request.Request(url, headers=headers)
+                with urllib.request.urlopen(request) as response:
+                    if received and response.status != 206:
+                        raise RuntimeError('Server does not support continuing an interrupted stream')
+
+                    # Reading in chunks doesn't notice a connection that closes early, so check the length ourselves
+                    length = response.getheader('Content-Length')
+                    expected = received + int(length) if length else None
+
+                    while True:
+                        chunk = response.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        process.stdin.write(chunk)
+                        received += len(chunk)
+
+                if expected is not None and received < expected:
+                    raise http.client.IncompleteRead(b'', expected - received)
+                break
+            except (OSError, http.client.HTTPException) as e:
+                # The encoder is still waiting for the rest, so only a dropped connection to the source is retried
+                if process.poll() is not None or attempt == retries:
+                    raise
+                delay = 2 ** attempt + random.random()
+                logging.warning('Stream was interrupted after {} bytes, continuing in {:.1f} seconds ({})'.format(
+                    received, delay, e
+                ))
+                time.sleep(delay)
+        process.stdin.close()
+    except BaseException:
+        process.kill()
+        process.wait()
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+
+    stderr = process.stderr.read()
+    if process.wait() != 0:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise RuntimeError('Streaming conversion to "{}" failed: {}'.format(
+            os.path.basename(dst_path),
+            stderr.decode('utf-8', 'replace').strip()
+        ))
+
+    # Return the path of the new file, along with the number of bytes we downloaded
+    os.replace(part_path, dst_path)
+    return dst_path, received
+
@@ -3,29 +3,46 @@
 # TODO: Progress indication during downloading/converting
 # TODO: Custom tagging in config file (maybe too complex for this kind of app)
 # TODO: Add more tagging fields (?)
-# TODO: Album art from video thumbnail
-# TODO: Consistent use of either httplib2 or urllib
 
 import argparse
 import atexit
+import concurrent.futures
 import configparser
+import copy
+import functools
+import hashlib
+import http.client
 import json
 import logging
 import os
+import queue
+import random
 import re
-import shutil
+import signal
 import sys
 import tempfile
-import urllib.error
-import urllib.parse
-import urllib.request
-
-import youtube_dl
+import threading
+import time
 
+import api
+import artcache
+import audiocache
 import auth
+import deletequeue
+import fileops
+import infocache
+import lock
+import metrics
+import pipeline
+import ratelimit
+import rules
+import state
 import tagging
+import transcode
 import util
 
+# youtube_dl takes longer to import than a whole run with an empty playlist, so it is only imported once a download starts
+
 # region Globals
 YOUTUBE_API_SERVICE_NAME = 'youtube'
 YOUTUBE_API_VERSION = 'v3'
@@ -34,9 +51,34 @@ CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 LOG_FILE = os.path.join(CURRENT_DIR, 'yt-music-dl.log')
 CONFIG_FILE = os.path.join(CURRENT_DIR, 'config.ini')
 CREDENTIALS_FILE = os.path.join(CURRENT_DIR, 'credentials.json')
-PID_FILE = os.path.join(tempfile.gettempdir(), 'yt-music-dl.pid')
+STATE_FILE = os.path.join(CURRENT_DIR, 'yt-music-dl.db')
+METRICS_FILE = os.path.join(CURRENT_DIR, 'yt-music-dl.metrics.jsonl')
+LOCK_DIR = tempfile.gettempdir()
+WORK_DIR = os.path.join(CURRENT_DIR, 'work')
+
+# Download in chunks of this size, so an interrupted download only has to fetch the chunk it was on
+DOWNLOAD_CHUNK_SIZE = 10 * 1024 * 1024
+
+# Longest time to wait before trying a track that keeps failing again
+MAX_RETRY_INTERVAL = 24 * 3600
+
+# Unfinished downloads that weren't touched for this long are given up on
+# Tracks that are still in a playlist are tried again well within this time, even when they keep failing
+MAX_ITEM_FILE_AGE = 7 * 24 * 3600
+
+# Files in the library that can be retagged
+TAGGABLE_EXTENSIONS = ('.mp3', '.m4a', '.mp4', '.opus', '.ogg')
+
+# Number of files a worker process retags at a time
+RETAG_BATCH_SIZE = 100
 # endregion
 
+# youtube-dl objects can't be shared between threads, so every worker keeps its own one for as long as it lives
+downloaders = threading.local()
+
+# Locks held by this process, released at exit
+held_locks = []
+
 
 def main():
     # Parse command line arguments
@@ -45,22 +87,6 @@ def main():
     # Configure logging options
     configure_logger(args.debug)
 
-    # Check if process is already running
-    if os.path.isfile(PID_FILE):
-        logging.debug("Process is already running, exiting")
-        sys.exit()
-    else:
-        pid = str(os.getpid())
-        try:
-            with open(PID_FILE, 'w') as file:
-                file.write(pid)
-        except PermissionError:
-            logging.exception('No permission to create PID file, make sure you are running as root')
-            sys.exit()
-    
-    # Configure cleanup at exit
-    atexit.register(cleanup)
-
     # Read the configuration file
     config = configparser.ConfigParser()
     if not os.path.isfile(CONFIG_FILE):
@@ -77,126 +103,668 @@ def main():
 
     # Get some data from the config file
     try:
-        output_dir = config['GENERAL']['OutputDirectory']
-        playlist_id = config['GENERAL']['PlaylistID']
+        output_dir = config['GENERAL'].get('OutputDirectory', '')
+        playlist_id = config['GENERAL'].get('PlaylistID', '')
         client_id = config['AUTHENTICATION']['ClientID']
         client_secret = config['AUTHENTICATION']['ClientSecret']
-    except KeyError:
+        prefetch_pages = config['GENERAL'].getboolean('PrefetchPages', fallback=True)
+    except (KeyError, ValueError):
         logging.exception(
             'Something is wrong with the content of the config file "' + os.path.basename(CONFIG_FILE) + '"'
         )
         sys.exit()
     logging.debug('Read config file')
 
-    # Check if any essential config fields are empty
-    if not output_dir:
-        logging.critical('Please enter an output directory in the config file.')
-        return
+    # Get all playlists we should download from, with their output directory and genre rules
+    playlists = get_playlists(config, playlist_id, output_dir)
 
-    if not playlist_id:
+    # Check if any essential config fields are empty
+    if not playlists:
         logging.critical('Please enter a playlist ID in the config file.')
         return
 
+    for playlist in playlists:
+        if not playlist['output_dir']:
+            logging.critical('Please enter an output directory in the config file.')
+            return
+
     if not client_id or not client_secret:
         logging.critical('Please enter your client ID and client secret in the config file.')
         return
 
+    # Compile the patterns for parsing video titles once, instead of for every track
+    try:
+        title_parser = get_title_parser(config)
+    except (re.error, ValueError) as e:
+        logging.critical('Please check the patterns in the TITLES section of the config file: {}'.format(e))
+        sys.exit()
+
     # If setup flag is passed, run first-time setup and exit
     if args.setup:
         logging.debug('Running setup...')
         setup(client_id, client_secret, CREDENTIALS_FILE)
         return
 
+    # If retag flag is passed, tag the files in the library again and exit
+    # This doesn't use the API or touch the playlists, so it can run next to a job that is downloading
+    if args.retag:
+        track_state = state.StateStore(STATE_FILE)
+        try:
+            retag_library(
+                playlists,
+                title_parser,
+                config.getint('PERFORMANCE', 'ConvertWorkers', fallback=os.cpu_count() or 1),
+                track_state
+            )
+        finally:
+            track_state.close()
+        return
+
+    # Configure cleanup at exit
+    atexit.register(cleanup)
+
+    # Check if another process is already working on our playlists
+    # Locks are per playlist, so jobs for different playlists can run side by side
+    playlists = acquire_locks(playlists)
+    if not playlists:
+        logging.debug("Process is already running, exiting")
+        sys.exit()
+
     # Log the start of the run
     logging.info('[START] Started run')
 
     # Get credentials to access API
     oauth = auth.OAuth(client_id, client_secret, CREDENTIALS_FILE)
 
-    # Get content of YouTube playlist
-    playlist_items = get_playlistitems(oauth, playlist_id)
-    logging.debug('Got playlist content')
+    # Get the concurrency limits of the pipeline stages and other settings from the config file
+    try:
+        settings = {
+            'playlists': playlists,
+            'prefetch_pages': prefetch_pages,
+            'create_subfolder': config['GENERAL'].getboolean('MonthBasedSubdir'),
+            'temp_dir': config['GENERAL'].get('TempDirectory') or WORK_DIR,
+            'streaming': config.getboolean('PERFORMANCE', 'StreamingTranscode', fallback=False),
+            'download_retries': config.getint('PERFORMANCE', 'DownloadRetries', fallback=5),
+            'info_cache_ttl': config.getfloat('PERFORMANCE', 'InfoCacheTTL', fallback=3600),
+            'audio_cache_size': config.getfloat('PERFORMANCE', 'AudioCacheSize', fallback=1024) * 1024 * 1024,
+            'codec_policy': config['GENERAL'].get('OutputCodec', 'mp3').strip().lower(),
+            'album_art': config.getboolean('GENERAL', 'AlbumArt', fallback=True),
+            'album_art_size': config.getint('GENERAL', 'AlbumArtSize', fallback=500),
+            'download_workers': config.getint('PERFORMANCE', 'DownloadWorkers', fallback=4),
+            'convert_workers': config.getint('PERFORMANCE', 'ConvertWorkers', fallback=os.cpu_count() or 1),
+            'finalize_workers': config.getint('PERFORMANCE', 'FinalizeWorkers', fallback=1),
+            'delete_workers': config.getint('PERFORMANCE', 'DeleteWorkers', fallback=4),
+            'delete_batch_size': config.getint('PERFORMANCE', 'DeleteBatchSize', fallback=25),
+            'playlist_concurrency': config.getint('PERFORMANCE', 'PlaylistConcurrency', fallback=0),
+            'poll_interval': config.getfloat('DAEMON', 'PollInterval', fallback=30),
+            'max_poll_interval': config.getfloat('DAEMON', 'MaxPollInterval', fallback=600),
+            'retry_interval': config.getfloat('GENERAL', 'RetryFailedAfter', fallback=3600),
+            'daily_quota': config.getint('API', 'DailyQuota', fallback=10000),
+            'requests_per_second': config.getfloat('API', 'RequestsPerSecond', fallback=10),
+            'title_parser': title_parser
+        }
+    except (KeyError, ValueError):
+        logging.exception(
+            'Something is wrong with the content of the config file "' + os.path.basename(CONFIG_FILE) + '"'
+        )
+        sys.exit()
 
-    for playlist_item in playlist_items:
-        # Get some info about the playlist item
-        video_id = playlist_item['snippet']['resourceId']['videoId']
-        video_title = playlist_item['snippet']['title']
-        channel = get_channel_name(oauth, video_id)
-        url = util.get_url(video_id)
+    # Check if we know the output codec
+    if settings['codec_policy'] not in transcode.POLICIES:
+        logging.critical('Please enter one of {} as OutputCodec in the config file.'.format(
+            ', '.join(transcode.POLICIES)
+        ))
+        sys.exit()
 
-        # Configure temporary storage location
-        temp_dir = tempfile.gettempdir()
-        temp_name = video_id + '.mp3'
-        temp_path = os.path.join(temp_dir, temp_name)
+    # Unfinished downloads are kept in the work directory, so they can be continued after a restart
+    # Files of single tracks go in a directory of their own, apart from the caches
+    settings['item_dir'] = os.path.join(settings['temp_dir'], 'items')
+    try:
+        os.makedirs(settings['item_dir'], exist_ok=True)
+    except PermissionError:
+        logging.exception('No permission to create work directory, make sure you are running as root')
+        sys.exit()
 
-        # Download video and extract audio
-        logging.info('Downloading video: {} ({})'.format(video_title, video_id))
-        download_audio(url, temp_dir)
+    # Open the record of stages completed by earlier runs
+    track_state = state.StateStore(STATE_FILE)
 
-        # Apply tags
-        try:
-            autotag(temp_path, video_title, config, channel)
-            logging.debug('Tagged mp3')
-        except KeyError:
-            logging.error('Could not tag mp3 file')
+    # API requests are paced, and counted against the daily quota, which is kept track of in the state store
+    client = api.ApiClient(
+        oauth,
+        ratelimit.TokenBucket(settings['requests_per_second']),
+        ratelimit.Quota(track_state, settings['daily_quota'])
+    )
 
-        # Move file to network storage
-        try:
-            # Get month based subdir value from config file
-            create_subfolder = config['GENERAL'].getboolean('MonthBasedSubdir')
-        except KeyError:
-            logging.exception(
-                'Something is wrong with the content of the config file "' + os.path.basename(CONFIG_FILE) + '"'
-            )
-            sys.exit()
-
-        # Join subdir with original output dir, if preferred
-        if create_subfolder:
-            final_dir = os.path.join(output_dir, util.get_formatted_date())
+    try:
+        if args.daemon:
+            run_daemon(client, settings, track_state)
         else:
-            final_dir = output_dir
+            # If the queue is emtpy, log it
+            if process_playlists(client, settings, track_state) == 0:
+                logging.info('Download queue is empty')
+    finally:
+        track_state.close()
+
+    # Log the end of the run
+    logging.info('[END] Finished run')
+
 
-        # Get filename and path from video title and above mentioned (sub)directory
-        final_name = util.remove_illegal_characters(video_title + '.mp3')
-        final_path = os.path.join(final_dir, final_name)
+def run_daemon(client, settings, track_state):
+    # Stop after the current poll when asked to terminate
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
 
-        # Create directory if it doesn't already exist
-        if not os.path.exists(final_dir):
+    logging.info('Running as daemon, polling playlist every {:g} seconds'.format(settings['poll_interval']))
+    interval = settings['poll_interval']
+
+    try:
+        while not stop.is_set():
             try:
-                os.makedirs(final_dir)
-            except PermissionError:
-                logging.exception('No permission to create output directory "' + final_dir + '"')
-                sys.exit()
+                item_count = process_playlists(client, settings, track_state)
+            except OSError:
+                # Network trouble shouldn't take the daemon down, just try again later
+                logging.exception('Could not process playlist')
+                item_count = 0
+
+            # Poll less often while the queue stays empty, and go back to the normal interval once there is work
+            if item_count == 0:
+                logging.debug('Download queue is empty, checking again in {:g} seconds'.format(interval))
+                wait = interval
+                interval = min(interval * 2, max(settings['max_poll_interval'], settings['poll_interval']))
+            else:
+                wait = interval = settings['poll_interval']
+
+            stop.wait(wait)
+    except KeyboardInterrupt:
+        pass
+
+    logging.info('Stopping daemon')
+
+
+def get_playlists(config, playlist_id, output_dir):
+    playlists = []
+
+    # The playlist from the GENERAL section, if any
+    if playlist_id:
+        playlists.append({'id': playlist_id, 'output_dir': output_dir})
+
+    # Playlist IDs are case sensitive, so read the PLAYLISTS section without lowercasing its keys
+    raw_config = configparser.ConfigParser()
+    raw_config.optionxform = str
+    raw_config.read(CONFIG_FILE)
+    if raw_config.has_section('PLAYLISTS'):
+        for key, value in raw_config['PLAYLISTS'].items():
+            if key not in [playlist['id'] for playlist in playlists]:
+                playlists.append({'id': key, 'output_dir': value or output_dir})
+
+    # Genre rules are taken from the CHANNELS section, and can be overridden per playlist
+    for playlist in playlists:
+        channels = {}
+        for section in ('CHANNELS', 'CHANNELS:' + playlist['id']):
+            if config.has_section(section):
+                channels.update((key.lower(), value) for key, value in config[section].items())
+        playlist['channels'] = channels
+
+    return playlists
+
+
+def get_title_parser(config):
+    if not config.has_section('TITLES'):
+        return rules.DEFAULT_PARSER
+
+    # Patterns are tried in the order they appear in, without interpolation since they are regular expressions
+    patterns = []
+    noise = []
+    for key, value in config.items('TITLES', raw=True):
+        if key.startswith('pattern'):
+            patterns.append(value)
+        elif key.startswith('noise'):
+            noise.append(value)
+
+    if not patterns and not noise:
+        return rules.DEFAULT_PARSER
+    return rules.TitleParser(patterns, noise)
+
+
+def process_playlists(client, settings, track_state):
+    metrics.start(METRICS_FILE)
+
+    # Playlist items are deleted in batches, off the critical path of the downloads
+    # Deletions left over from an interrupted run go first, so those items don't show up as new
+    deletions = deletequeue.DeleteQueue(
+        track_state,
+        functools.partial(delete_playlist_item, client),
+        workers=settings['delete_workers'],
+        batch_size=settings['delete_batch_size']
+    )
+    deletions.add_unfinished([playlist['id'] for playlist in settings['playlists']])
+    deletions.flush()
+
+    # Files of tracks that never finished, because they were removed from the playlist or failed for good,
+    # would otherwise stay in the work directory forever
+    removed = fileops.remove_old_files(settings['item_dir'], MAX_ITEM_FILE_AGE)
+    if removed:
+        logging.info('Removed {} files of unfinished downloads that were not touched for a week'.format(removed))
+
+    # Info extracted by youtube-dl is kept for a while, so retries and the next run don't have to extract it again
+    info_cache = infocache.InfoCache(os.path.join(settings['temp_dir'], 'info'), settings['info_cache_ttl'])
+    info_cache.prune()
+
+    # Converted audio is kept as well, for videos that are in more than one playlist or come back later
+    audio_cache = audiocache.AudioCache(os.path.join(settings['temp_dir'], 'audio'), settings['audio_cache_size'])
+
+    # Album art is downloaded next to the audio, instead of holding up tagging
+    art_cache = None
+    if settings['album_art']:
+        art_cache = artcache.ArtCache(
+            os.path.join(settings['temp_dir'], 'art'),
+            settings['album_art_size'],
+            settings['download_workers']
+        )
+        art_cache.prune()
+
+    # Downloads spend most of their time waiting on the network, conversions are bound by CPU,
+    # and tagging, moving and deleting are quick, so each stage gets its own worker pool
+    # Tracks that fail are remembered, so they can be given a rest before they're tried again
+    downloader = pipeline.Pipeline([
+        pipeline.Stage('download', functools.partial(
+            download_track,
+            track_state=track_state,
+            codec_policy=settings['codec_policy'],
+            streaming=settings['streaming'],
+            retries=settings['download_retries'],
+            info_cache=info_cache,
+            audio_cache=audio_cache,
+            create_subfolder=settings['create_subfolder']
+        ), settings['download_workers']),
+        pipeline.Stage('convert', functools.partial(
+            convert_track,
+            track_state=track_state,
+            codec_policy=settings['codec_policy'],
+            audio_cache=audio_cache
+        ), settings['convert_workers']),
+        pipeline.Stage('finalize', functools.partial(
+            finalize_track,
+            create_subfolder=settings['create_subfolder'],
+            track_state=track_state,
+            deletions=deletions
+        ), settings['finalize_workers'])
+    ], on_error=lambda track, error: track_state.record_failure(track['playlist_item']['id']))
+
+    # Walk through the content of every playlist, one page at a time
+    playlists = {playlist['id']: playlist for playlist in settings['playlists']}
+    iterators = {
+        playlist_id: iter_playlistitems(client, playlist_id, settings['prefetch_pages'], track_state)
+        for playlist_id in playlists
+    }
+
+    # Limit the number of tracks each playlist can have in the pipeline, so a huge one can't crowd out the others
+    concurrency = settings['playlist_concurrency'] or len(downloader.stages) * settings['download_workers']
+    slots = {playlist_id: threading.BoundedSemaphore(concurrency) for playlist_id in playlists}
+    slot_freed = threading.Event()
+
+    def release_slot(playlist_id):
+        slots[playlist_id].release()
+        slot_freed.set()
 
-        # Move file to final destination
+    # Only take on as many tracks as the API quota that is left today can pay for
+    budget = client.quota.remaining() if client.quota is not None else None
+
+    item_count = 0
+    try:
+        while iterators:
+            slot_freed.clear()
+            progressed = False
+
+            # Take turns, one track from every playlist that has room for it
+            for playlist_id in list(iterators):
+                if not slots[playlist_id].acquire(blocking=False):
+                    continue
+
+                if budget is not None and budget < ratelimit.TRACK_COST:
+                    logging.info('Not enough API quota left today, leaving the rest of the playlists for later')
+                    iterators.clear()
+                    slots[playlist_id].release()
+                    break
+
+                try:
+                    playlist_item = next(iterators[playlist_id])
+                except StopIteration:
+                    del iterators[playlist_id]
+                    slots[playlist_id].release()
+                    continue
+                except ratelimit.QuotaExceeded:
+                    iterators.clear()
+                    slots[playlist_id].release()
+                    break
+                except (api.HTTPError, OSError):
+                    # Other playlists may still work, only skip this one until the next run
+                    logging.error('Skipping playlist {} for this run'.format(playlist_id))
+                    del iterators[playlist_id]
+                    slots[playlist_id].release()
+                    continue
+
+                # Leave tracks that failed recently alone, so a broken video isn't tried again on every poll
+                if not retry_due(track_state, playlist_item['id'], settings['retry_interval']):
+                    logging.debug('Skipping video that failed recently: {}'.format(playlist_item['snippet']['title']))
+                    slots[playlist_id].release()
+                    progressed = True
+                    continue
+
+                if budget is not None:
+                    budget -= ratelimit.TRACK_COST
+
+                item_count += 1
+                progressed = True
+
+                # Get some info about the playlist item
+                video_id = playlist_item['snippet']['resourceId']['videoId']
+                track = {
+                    'playlist_id': playlist_id,
+                    'playlist_item': playlist_item,
+                    'video_id': video_id,
+                    'title': playlist_item['snippet']['title'],
+                    'channel': playlist_item['snippet'].get('videoOwnerChannelTitle'),
+                    'url': util.get_url(video_id),
+                    'output_dir': playlists[playlist_id]['output_dir'],
+                    'channels': playlists[playlist_id]['channels'],
+                    'title_parser': settings['title_parser'],
+                    'temp_dir': settings['item_dir'],
+                    'path': None,
+                    'acodec': None,
+                    'stage': None,
+                    'art': None,
+                    'started': time.time()
+                }
+
+                # Start fetching the album art, it's needed once the audio is ready
+                thumbnail_url = artcache.pick_thumbnail(
+                    playlist_item['snippet'].get('thumbnails'), settings['album_art_size']
+                )
+                if art_cache is not None and thumbnail_url:
+                    track['art'] = art_cache.fetch(thumbnail_url)
+
+                # Hand the track to the pipeline, this blocks when the workers are too far behind
+                downloader.submit(track, functools.partial(release_slot, playlist_id))
+
+            # Every playlist with work left is at its limit, wait for one of its tracks to finish
+            if not progressed and iterators:
+                slot_freed.wait()
+    finally:
+        # Wait for all tracks to be processed and their playlist items to be deleted
         try:
-            shutil.copy(temp_path, final_path)
-            os.remove(temp_path)
-        except PermissionError:
-            logging.exception('No permission to create output directory "' + final_dir + '"')
-            sys.exit()
-        except FileNotFoundError:
-            logging.exception('Could not find output directory or downloaded file has gone missing.' +
-                              'Check "' + os.path.basename(CONFIG_FILE) + '" to see if OutputDirectory is correct.')
-            sys.exit()
+            downloader.join()
+        finally:
+            deletions.close()
+            if art_cache is not None:
+                art_cache.close()
+            metrics.finish()
+
+            if client.quota is not None and client.quota.run_units:
+                logging.debug('Used {} API quota units so far, {} today'.format(
+                    client.quota.run_units, client.quota.used()
+                ))
+
+    return item_count
+
+
+def retry_due(track_state, playlist_item_id, retry_interval):
+    attempts, failed = track_state.get_failure(playlist_item_id)
+    if not attempts:
+        return True
+
+    # Wait twice as long after every failure
+    return time.time() >= failed + min(retry_interval * 2 ** (attempts - 1), MAX_RETRY_INTERVAL)
+
+
+def download_track(track, track_state, codec_policy, streaming=False, retries=5, info_cache=None, audio_cache=None,
+                   create_subfolder=False):
+    item_id = track['playlist_item']['id']
+
+    # Pick up where an earlier run left off
+    track['stage'], track['path'] = track_state.resume(item_id)
+
+    if track['stage'] is None:
+        # If the same video is already in the library, there is no need to download it again
+        library_path = track_state.find_in_library(track['video_id'])
+        if library_path:
+            logging.info('Video is already in library: {} ({})'.format(track['title'], track['video_id']))
+
+            # Another playlist's output directory gets a link to the file, rather than a copy of it
+            if not is_in_directory(library_path, track['output_dir']):
+                library_path = link_to_library(library_path, track['title'], track['output_dir'], create_subfolder)
+
+            track['stage'], track['path'] = 'moved', library_path
+            track_state.mark(item_id, track['video_id'], track['stage'], track['path'], track['playlist_id'])
+
+    if track['stage'] is None and audio_cache is not None:
+        # Converted audio from an earlier download of this video only needs to be tagged
+        key = audio_cache.get_key(track['video_id'], transcode.get_settings(codec_policy))
+        with metrics.stage('cache', track['video_id']):
+            path = audio_cache.copy_to(key, os.path.join(track['temp_dir'], item_id))
+        if path:
+            logging.info('Using cached audio: {} ({})'.format(track['title'], track['video_id']))
+            track['stage'], track['path'] = 'converted', path
+            track_state.mark(item_id, track['video_id'], track['stage'], track['path'], track['playlist_id'])
+            return track
+
+    if track['stage'] is not None:
+        logging.info('Resuming video after stage "{}": {} ({})'.format(
+            track['stage'], track['title'], track['video_id']
+        ))
+
+        # Unfinished downloads that are still being worked on must not be cleaned up
+        if not state.reached(track['stage'], 'moved'):
+            try:
+                os.utime(track['path'])
+            except OSError:
+                pass
+        return track
+
+    # Download, convert and tag in one pass, if we can
+    if streaming:
+        with metrics.stage('extract', track['video_id']):
+            stream_info = get_stream_info(track['url'], transcode.FORMATS[codec_policy], info_cache)
+        set_channel(track, stream_info)
+        protocol = stream_info.get('protocol')
+        if protocol in ('http', 'https') and transcode.can_stream(codec_policy, stream_info.get('acodec')):
+            logging.info('Streaming video: {} ({})'.format(track['title'], track['video_id']))
+
+            # Tags are written by the encoder, so tagging doesn't need another pass over the file
+            try:
+                tags = get_tags(track['title'], track['channels'], track['channel'], track['title_parser'])
+            except KeyError:
+                logging.error('Could not tag audio file')
+                tags = []
+            metadata = {tag.fieldname: tag.value for tag in tags if tag.value and not tag.value.isspace()}
 
+            try:
+                with metrics.stage('stream', track['video_id']) as timing:
+                    track['path'], timing['bytes'] = transcode.stream_audio(
+                        stream_info['url'],
+                        stream_info.get('http_headers'),
+                        os.path.join(track['temp_dir'], item_id),
+                        codec_policy,
+                        stream_info.get('acodec'),
+                        metadata,
+                        retries
+                    )
+            except Exception:
+                # The stream URL may have expired, don't use it again
+                if info_cache is not None:
+                    info_cache.drop(track['url'])
+                raise
+
+            # The encoder only writes the tags from the title, the rest is added to the file it produced in one write
+            try:
+                tagging.apply_tags(
+                    get_source_tags(track['title'], track['url'], track['channel']),
+                    track['path'],
+                    get_art(track)
+                )
+            except Exception:
+                logging.exception('Could not add album art and source tags')
+
+            track['stage'] = 'tagged'
+            track_state.mark(item_id, track['video_id'], track['stage'], track['path'], track['playlist_id'])
+            return track
+
+        # Fragmented streams can't be piped directly, those go through the regular stages
+        logging.debug('Cannot stream this video, downloading instead')
+
+    # Download the audio stream of the video
+    logging.info('Downloading video: {} ({})'.format(track['title'], track['video_id']))
+    with metrics.stage('download', track['video_id']) as timing:
+        track['path'], info = download_audio(
+            track['url'],
+            track['temp_dir'],
+            item_id,
+            transcode.FORMATS[codec_policy],
+            retries,
+            info_cache
+        )
+        timing['bytes'] = os.path.getsize(track['path'])
+    track['acodec'] = info.get('acodec')
+    set_channel(track, info)
+    track['stage'] = 'downloaded'
+    track_state.mark(item_id, track['video_id'], track['stage'], track['path'], track['playlist_id'])
+    return track
+
+
+def set_channel(track, info):
+    # Older playlist items don't say which channel the video is from, but the extracted info does
+    if not track['channel']:
+        track['channel'] = info.get('channel') or info.get('uploader')
+
+
+def convert_track(track, track_state, codec_policy, audio_cache=None):
+    if state.reached(track['stage'], 'converted'):
+        return track
+
+    # Extract the audio to the configured codec, or just remux it if it already is
+    logging.info('Converting video: {} ({})'.format(track['title'], track['video_id']))
+    temp_base = os.path.join(track['temp_dir'], track['playlist_item']['id'])
+    with metrics.stage('convert', track['video_id']) as timing:
+        track['path'] = transcode.convert_audio(track['path'], temp_base, codec_policy, track['acodec'])
+        timing['bytes'] = os.path.getsize(track['path'])
+
+    # Keep a copy before it's tagged, tags can differ between playlists but the audio doesn't
+    if audio_cache is not None:
+        audio_cache.put(audio_cache.get_key(track['video_id'], transcode.get_settings(codec_policy)), track['path'])
+
+    track['stage'] = 'converted'
+    track_state.mark(
+        track['playlist_item']['id'], track['video_id'], track['stage'], track['path'], track['playlist_id']
+    )
+    return track
+
+
+def finalize_track(track, create_subfolder, track_state, deletions):
+    item_id = track['playlist_item']['id']
+    video_title = track['title']
+
+    # Apply tags
+    if not state.reached(track['stage'], 'tagged'):
+        try:
+            with metrics.stage('tag', track['video_id']):
+                autotag(
+                    track['path'],
+                    video_title,
+                    track['channels'],
+                    track['channel'],
+                    track['title_parser'],
+                    get_art(track),
+                    track['url']
+                )
+            logging.debug('Tagged audio file')
+        except KeyError:
+            logging.error('Could not tag audio file')
+
+        track['stage'] = 'tagged'
+        track_state.mark(item_id, track['video_id'], track['stage'], track['path'], track['playlist_id'])
+
+    if not state.reached(track['stage'], 'moved'):
+        with metrics.stage('move', track['video_id']) as timing:
+            timing['bytes'] = os.path.getsize(track['path'])
+            track['path'] = move_to_library(track['path'], video_title, track['output_dir'], create_subfolder)
+        track['stage'] = 'moved'
+        track_state.mark(item_id, track['video_id'], track['stage'], track['path'], track['playlist_id'])
+        track_state.clear_failure(item_id)
         logging.debug('Moved file to final destination')
 
-        # Delete the playlistitem after downloading
-        delete_playlist_item(oauth, playlist_item)
-        logging.debug('Deleted playlist item')
+    # Queue the playlistitem for deletion after downloading
+    deletions.add(item_id, track['video_id'], track['path'])
 
-    # If the queue is emtpy, log it
-    if len(playlist_items) == 0:
-        logging.info('Download queue is empty')
+    # Record how long the track took from entering the pipeline until now
+    if metrics.current is not None:
+        metrics.current.record('track', time.time() - track['started'], track['video_id'])
 
-    # Log the end of the run
-    logging.info('[END] Finished run')
+    return track
+
+
+def get_library_path(temp_path, video_title, output_dir, create_subfolder):
+    # Join subdir with original output dir, if preferred
+    if create_subfolder:
+        final_dir = os.path.join(output_dir, util.get_formatted_date())
+    else:
+        final_dir = output_dir
+
+    # Get filename and path from video title and above mentioned (sub)directory
+    final_name = util.remove_illegal_characters(video_title + os.path.splitext(temp_path)[1])
+    final_path = os.path.join(final_dir, final_name)
+
+    # Create directory if it doesn't already exist
+    try:
+        os.makedirs(final_dir, exist_ok=True)
+    except PermissionError:
+        logging.exception('No permission to create output directory "' + final_dir + '"')
+        sys.exit()
+
+    return final_path
+
+
+def move_to_library(temp_path, video_title, output_dir, create_subfolder):
+    final_path = get_library_path(temp_path, video_title, output_dir, create_subfolder)
+    final_dir = os.path.dirname(final_path)
+
+    # Move file to final destination, atomically so the library never contains partial files
+    try:
+        fileops.move_file(temp_path, final_path)
+    except PermissionError:
+        logging.exception('No permission to create output directory "' + final_dir + '"')
+        sys.exit()
+    except FileNotFoundError:
+        logging.exception('Could not find output directory or downloaded file has gone missing.' +
+                          'Check "' + os.path.basename(CONFIG_FILE) + '" to see if OutputDirectory is correct.')
+        sys.exit()
+
+    return final_path
+
+
+def link_to_library(library_path, video_title, output_dir, create_subfolder):
+    final_path = get_library_path(library_path, video_title, output_dir, create_subfolder)
+
+    # Link the file that is already in the library, this only copies it if the directories are on different filesystems
+    try:
+        return fileops.link_file(library_path, final_path)
+    except PermissionError:
+        logging.exception('No permission to write to output directory "' + os.path.dirname(final_path) + '"')
+        sys.exit()
+
+
+def is_in_directory(path, directory):
+    # Whether a path is somewhere below a directory, including its month based subdirectories
+    path = os.path.abspath(path)
+    directory = os.path.abspath(directory)
+    try:
+        return os.path.commonpath([path, directory]) == directory
+    except ValueError:
+        return False
 
 
 def progress_hook(d):
     if d['status'] == 'finished':
-        logging.info('Converting video')
+        logging.debug('Finished downloading ' + os.path.basename(d['filename']))
 
 
 def configure_logger(debug):
@@ -228,165 +796,248 @@ def configure_logger(debug):
     logger.addHandler(handler)
 
 
-def get_channel_name(oauth, video_id):
-    url = 'https://www.googleapis.com/youtube/v3/videos'
-
+def get_playlistitems(client, playlist_id, page_token=None, track_state=None):
+    # Declare parameters
     params = {
         'part': 'snippet',
-        'id': video_id,
+        'playlistId': playlist_id,
+        'maxResults': 50  # 0 - 50 are accepted
     }
 
-    # Header contains authorization data
-    header = {'Authorization': (oauth.credentials['token_type'] + ' ' + oauth.credentials['access_token'])}
-
-    # Encode and parse parameters into URL
-    params = urllib.parse.urlencode(params)
-    full_url = url + '?' + params
+    # Continue from a previous page, if requested
+    if page_token:
+        params['pageToken'] = page_token
 
-    # Create request object and add authentication header
-    req = urllib.request.Request(full_url)
-    for k in header:
-        req.add_header(k, header[k])
+    # Only have the page sent if it changed since we last got it, otherwise the server answers with a 304
+    cached = track_state.get_page(playlist_id, page_token) if track_state is not None else None
+    headers = {'If-None-Match': cached[0]} if cached else None
 
-    # Get response from API request
     try:
-        response = urllib.request.urlopen(req)
-    except urllib.error.HTTPError as e:
-        if e.code == 401:
-            # Get a new access token
-            oauth.authorize_credentials()
-
-            # Update authorization header for request
-            req.remove_header('Authorization')
-            header = {'Authorization': (oauth.credentials['token_type'] + ' ' + oauth.credentials['access_token'])}
-            for k in header:
-                req.add_header(k, header[k])
-
-            # Retry request with new access token
-            try:
-                response = urllib.request.urlopen(req)
-            except urllib.error.HTTPError:
-                logging.exception('Could not complete API request to get channel name')
-                sys.exit()
-        else:
-            logging.exception('Could not complete API request to get channel name')
-            sys.exit()
+        # Get response from API request
+        with metrics.stage('list') as timing:
+            response = client.call('GET', 'playlistItems', params, headers)
+            timing['bytes'] = len(response.body)
 
-    # Decode and parse json response
-    str_response = response.read().decode('utf-8')
-    data = json.loads(str_response)
+        if response.status == 304:
+            logging.debug('Playlist page has not changed')
+            playlistitems_list = json.loads(cached[1])
+        else:
+            playlistitems_list = response.json()
+            etag = response.headers.get('ETag')
+            if etag and track_state is not None:
+                track_state.put_page(playlist_id, page_token, etag, response.body.decode('utf-8'))
+    except api.HTTPError as e:
+        if e.code == 404:
+            logging.critical('Could not complete API request to get playlist content, ' + 
+                             'check if playlist ID in "' + os.path.basename(CONFIG_FILE) + '" is correct')
+        else:
+            logging.exception('Could not complete API request to get playlist content')
+        raise
 
-    # Return the channel title
     try:
-        return data['items'][0]['snippet']['channelTitle']
+        # Return the items from the list, along with the token of the next page (if any)
+        return playlistitems_list['items'], playlistitems_list.get('nextPageToken')
     except KeyError:
-        logging.exception('Received unexpected response from API server while getting channel name')
+        logging.exception('Received unexpected response from API server while getting playlist content')
         sys.exit()
 
 
-def get_playlistitems(oauth, playlist_id):
-    # Declare request URL
-    url = 'https://www.googleapis.com/youtube/v3/playlistItems'
+def iter_playlistitem_pages(client, playlist_id, prefetch=False, track_state=None):
+    # Playlist items that have already been handed out during this run
+    seen = set()
 
-    # Declare header with authorization info
-    header = {'Authorization': (oauth.credentials['token_type'] + ' ' + oauth.credentials['access_token'])}
+    while True:
+        new_items = 0
 
-    # Declare parameters
-    params = {
-        'part': 'snippet',
-        'playlistId': playlist_id,
-        'maxResults': 50  # 0 - 50 are accepted
-    }
+        for page in iter_playlist_pass(client, playlist_id, prefetch, track_state):
+            # Skip items we have already yielded during an earlier pass
+            page = [item for item in page if item['id'] not in seen]
+            seen.update(item['id'] for item in page)
+            new_items += len(page)
 
-    # Encode and parse parameters into URL
-    params = urllib.parse.urlencode(params)
-    full_url = url + '?' + params
+            if page:
+                yield page
 
-    # Create request object and add authentication header
-    req = urllib.request.Request(full_url)
-    for k in header:
-        req.add_header(k, header[k])
+        # Page tokens are offsets into the playlist, so deleting items while paging makes later pages
+        # skip over items. Keep making passes until one of them turns up nothing we haven't seen yet.
+        if new_items == 0:
+            return
 
-    try:
-        # Get response from API request
-        response = urllib.request.urlopen(req)
-    except urllib.error.HTTPError as e:
-        if e.code == 401:
-            # Get a new access token
-            oauth.authorize_credentials()
-
-            # Update authorization header for request
-            req.remove_header('Authorization')
-            header = {'Authorization': (oauth.credentials['token_type'] + ' ' + oauth.credentials['access_token'])}
-            for k in header:
-                req.add_header(k, header[k])
+        logging.debug('Checking playlist again for items skipped while paging')
 
+
+def iter_playlist_pass(client, playlist_id, prefetch=False, track_state=None):
+    # Without prefetching, simply fetch each page once the previous one has been processed
+    if not prefetch:
+        page_token = None
+        while True:
+            items, page_token = get_playlistitems(client, playlist_id, page_token, track_state)
+            yield items
+            if not page_token:
+                return
+
+    # With prefetching, a background thread fetches the next page while the current one is being processed
+    pages = queue.Queue(maxsize=1)
+
+    # Set when the consumer stops early, like when the quota runs out, so the thread doesn't wait on it forever
+    stopped = threading.Event()
+
+    def put_page(result):
+        # Returns False if the consumer is gone
+        while not stopped.is_set():
             try:
-                # Retry request with new access token
-                response = urllib.request.urlopen(req)
-            except urllib.error.HTTPError:
-                logging.exception('Could not complete API request to get playlist content')
-                sys.exit()
-        elif e.code == 404:
-            logging.critical('Could not complete API request to get playlist content, ' + 
-                             'check if playlist ID in "' + os.path.basename(CONFIG_FILE) + '" is correct')
-            sys.exit()
-        else:
-            logging.exception('Could not complete API request to get playlist content')
-            sys.exit()
+                pages.put(result, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch_pages():
+        try:
+            token = None
+            while not stopped.is_set():
+                result = get_playlistitems(client, playlist_id, token, track_state)
+                if not put_page(result):
+                    return
+                token = result[1]
+                if not token:
+                    return
+        except BaseException as e:
+            # Hand errors (including sys.exit) over to the main thread
+            put_page(e)
+
+    thread = threading.Thread(target=fetch_pages, daemon=True)
+    thread.start()
 
     try:
-        # Decode and parse json response
-        str_response = response.read().decode('utf-8')
-        playlistitems_list = json.loads(str_response)
+        while True:
+            result = pages.get()
+            if isinstance(result, BaseException):
+                raise result
+
+            items, page_token = result
+            yield items
+            if not page_token:
+                return
+    finally:
+        stopped.set()
+
+
+def iter_playlistitems(client, playlist_id, prefetch=False, track_state=None):
+    # Yield single items as soon as their page has arrived
+    for page in iter_playlistitem_pages(client, playlist_id, prefetch, track_state):
+        yield from page
+
+
+def get_downloader():
+    # Setting up youtube-dl loads all of its extractors and a cookie jar, so only do that once per thread
+    ydl = getattr(downloaders, 'ydl', None)
+    if ydl is None:
+        import youtube_dl
+        ydl = youtube_dl.YoutubeDL({
+            'logger': logging.getLogger(),
+            'progress_hooks': [progress_hook],
+            # Keep the time the file was written, unfinished downloads are cleaned up based on it
+            'updatetime': False
+        })
+        downloaders.ydl = ydl
+    return ydl
+
+
+def extract_info(ydl, url, info_cache=None):
+    # Get the info of a video as the extractor returns it, before any format has been picked
+    info = info_cache.get(url) if info_cache is not None else None
+    if info is None:
+        info = ydl.extract_info(url, download=False, process=False)
+        if info_cache is not None:
+            info_cache.put(url, info)
+    else:
+        logging.debug('Using cached info of ' + url)
 
-        # Return the items from the list
-        return playlistitems_list['items']
-    except KeyError:
-        logging.exception('Received unexpected response from API server while getting playlist content')
-        sys.exit()
+    # Processing the info changes it, so leave the cached copy alone
+    return copy.deepcopy(info)
+
+
+def download_audio(url, out_dir, name, audio_format='bestaudio/best', retries=5, info_cache=None):
+    import youtube_dl
 
+    ydl = get_downloader()
 
-def download_audio(url, out_dir):
     # Set options for youtube-dl
-    ydl_opts = {
-        'outtmpl': os.path.join(out_dir, '%(id)s.%(ext)s'),
-        'format': 'bestaudio/best',
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-        }],
-        'logger': logging.getLogger(),
-        'progress_hooks': [progress_hook]
-    }
+    # Conversion happens in a separate stage, so only download the audio stream here
+    # Unfinished downloads are kept as .part files, which are continued with a range request instead of starting over
+    ydl.params.update({
+        'outtmpl': os.path.join(out_dir, name + '.%(ext)s'),
+        'format': audio_format,
+        'continuedl': True,
+        'retries': retries,
+        'fragment_retries': retries,
+        'http_chunk_size': DOWNLOAD_CHUNK_SIZE
+    })
+
+    # Download audio from url and return the path of the downloaded file, along with the info of the video
+    for attempt in range(retries + 1):
+        try:
+            info = ydl.process_ie_result(extract_info(ydl, url, info_cache), download=True)
+            return ydl.prepare_filename(info), info
+        except PermissionError:
+            logging.exception('No permission to run youtube_dl, try running as root')
+            sys.exit()
+        except youtube_dl.utils.DownloadError as e:
+            # The stream URLs in the cached info may be what failed, so extract them again next time
+            if info_cache is not None:
+                info_cache.drop(url)
+
+            if attempt == retries or not is_transient_download_error(e):
+                raise
+
+            # youtube-dl retries right away, give the connection some time to come back before we try again
+            delay = 2 ** attempt + random.random()
+            logging.warning('Download was interrupted, continuing in {:.1f} seconds'.format(delay))
+            time.sleep(delay)
+
+
+def is_transient_download_error(error):
+    import youtube_dl
+
+    # Extraction errors are only worth retrying when the network was to blame, not when the video is gone
+    cause = error.exc_info[1] if error.exc_info else None
+    if isinstance(cause, youtube_dl.utils.ExtractorError):
+        cause = cause.cause or cause.exc_info[1]
+
+    return isinstance(cause, (OSError, http.client.HTTPException, youtube_dl.utils.ContentTooShortError))
+
+
+def get_stream_info(url, audio_format='bestaudio/best', info_cache=None):
+    # Select the audio stream like download_audio does, without downloading anything
+    ydl = get_downloader()
+    ydl.params['format'] = audio_format
 
-    # Download and extract audio from url
     try:
-        youtube_dl.YoutubeDL(ydl_opts).download([url])
+        return ydl.process_ie_result(extract_info(ydl, url, info_cache), download=False)
     except PermissionError:
         logging.exception('No permission to run youtube_dl, try running as root')
         sys.exit()
 
 
-def autotag(path, video_title, config, channel=None):
-    # Compile regex
-    p = re.compile(r'(.*)(?:\s+-\s+)(.*)')
+def get_tags(video_title, channels, channel=None, title_parser=None):
+    # Split the title into artist, title and the like, using patterns that were compiled at startup
+    parts = (title_parser or rules.DEFAULT_PARSER).parse(video_title)
 
-    # Match regex against YouTube video title
-    m = p.match(video_title)
-
-    # Check if regex matches. If not, don't tag anything at all
-    if m:
-        # Get artist and title tags from regex
-        artist = m.group(1)
-        title = m.group(2)
+    # Check if any pattern matches. If not, don't tag anything at all
+    if parts:
+        artist = parts['artist']
+        title = parts['title']
         genre = None
 
-        # Set genre based on channel
-        logging.debug('Channel name: ' + channel.lower())
-        for key in config['CHANNELS']:
-            if channel.lower() == str(key).lower():
-                genre = config['CHANNELS'][key]
+        # Featured artists are credited along with the main artist
+        if 'featuring' in parts:
+            artist += ' feat. ' + parts['featuring']
+
+        # Set genre based on channel, if we know it
+        if channel:
+            logging.debug('Channel name: ' + channel.lower())
+            genre = channels.get(channel.lower())
 
         # Create tag objects and add them to a list
         tags = [
@@ -395,71 +1046,215 @@ def autotag(path, video_title, config, channel=None):
             tagging.Tag('genre', genre)
         ]
 
-        # tags = tagging.Tag('artist', artist)
-
         # Output debug tagging info
         # <Field>: <Value>
         for tag in tags:
             logging.debug(str(tag.fieldname) + ': ' + str(tag.value))
 
-        # Apply tags to MP3 file
-        tagging.apply_tags(tags, path)
-
-
-def delete_playlist_item(oauth, playlist_item):
-    # Get the unique id of the playlist item
-    pi_id = playlist_item['id']
-
-    # Declare request URL
-    url = 'https://www.googleapis.com/youtube/v3/playlistItems'
+        return tags
+
+    return []
+
+
+def get_source_tags(video_title, url=None, channel=None):
+    # Where the track came from, so it can be tagged again later without going back to YouTube
+    return [
+        tagging.Tag('comment', video_title),
+        tagging.Tag('url', url),
+        tagging.Tag('channel', channel)
+    ]
+
+
+def autotag(path, video_title, channels, channel=None, title_parser=None, art=None, url=None):
+    # Check if the title could be parsed. If not, only the album art and where the track came from are added
+    tags = get_tags(video_title, channels, channel, title_parser) + get_source_tags(video_title, url, channel)
+
+    # Apply tags to audio file, all at once
+    tagging.apply_tags(tags, path, art)
+
+
+def get_art(track):
+    # Album art was fetched in the background while the track was downloaded
+    if track.get('art') is None:
+        return None
+    return track['art'].result()
+
+
+def retag_library(playlists, title_parser, workers, track_state):
+    # Tag the files already in the library again, for when the genre rules or title patterns changed
+    # Files are only read when they are new or changed since the last retag, and only written when their tags change
+    index = track_state.get_library_index()
+    seen = set()
+    seen_files = set()
+    jobs = []
+    unchanged = 0
+    skipped = 0
+
+    for playlist in playlists:
+        for path, stat in scan_library(playlist['output_dir']):
+            # Playlists can share an output directory, and a video in more than one playlist is one file,
+            # hard linked into each of their directories. Every file is tagged once,
+            # with the rules of the first playlist in the config file that has it
+            seen.add(path)
+            if (stat.st_dev, stat.st_ino) in seen_files:
+                continue
+            seen_files.add((stat.st_dev, stat.st_ino))
+            mtime = stat.st_mtime
+
+            # Files that didn't change since the last retag are checked against the index, without opening them
+            source = None
+            entry = index.get(path)
+            if entry is not None and entry[0] == mtime:
+                # Files without a video title to tag from were looked at before, and are left as they are
+                if not entry[1]:
+                    skipped += 1
+                    continue
+
+                source = entry[1], entry[2]
+                if hash_tags(get_retag_tags(source[0], playlist['channels'], source[1], title_parser)) == entry[3]:
+                    unchanged += 1
+                    continue
+
+            jobs.append((path, playlist['channels'], source))
+
+    logging.info('Found {} files in library, {} to check'.format(len(seen_files), len(jobs)))
+
+    # Reading and writing tags is mostly parsing, so the files are spread over worker processes in batches
+    entries = []
+    written = 0
+    failed = 0
+    if jobs:
+        batches = [jobs[i:i + RETAG_BATCH_SIZE] for i in range(0, len(jobs), RETAG_BATCH_SIZE)]
+        with concurrent.futures.ProcessPoolExecutor(max(1, workers)) as executor:
+            for batch_entries, batch_written, batch_skipped, batch_failed in executor.map(
+                functools.partial(retag_files, title_parser=title_parser), batches
+            ):
+                entries += batch_entries
+                written += batch_written
+                skipped += batch_skipped
+                failed += batch_failed
+
+    # Files that are gone from the library are dropped from the index
+    track_state.update_library_index(entries, [path for path in index if path not in seen])
+
+    # Entries without a video title are the files that were skipped
+    checked = sum(1 for entry in entries if entry[2])
+    logging.info('Retagged {} files, {} were already up to date, {} have no video title to tag from, {} failed'.format(
+        written, unchanged + checked - written, skipped, failed
+    ))
+
+
+def scan_library(directory):
+    # Get the path and stat result of every file that can be tagged, including the ones in month subdirectories
+    # The directory entries already tell which ones are directories, so only files need a stat call
+    directories = [directory]
+    while directories:
+        try:
+            entries = os.scandir(directories.pop())
+        except OSError:
+            logging.exception('Could not read output directory')
+            continue
+
+        with entries:
+            for entry in entries:
+                # Hidden files include the temporary ones used while moving files into the library
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in TAGGABLE_EXTENSIONS:
+                        yield entry.path, entry.stat()
+                except OSError:
+                    pass
+
+
+def retag_files(jobs, title_parser):
+    # Runs in a worker process. Gets the index entries of the files that were checked,
+    # and how many files were written, skipped and failed
+    from mutagen import MutagenError
+
+    checked = []
+    writes = []
+    skipped = 0
+    failed = 0
+
+    for path, channels, source in jobs:
+        current = None
+        try:
+            if source is None:
+                current = tagging.read_tags(path, ['title', 'artist', 'genre', 'comment', 'channel'])
+
+                # The original video title is in the comment. Files downloaded before it was kept don't have it,
+                # and their file name has lost characters like "/" and ":", so their tags are better left alone
+                # They get an index entry without a title, so they aren't read again until they change
+                if not current.get('comment'):
+                    logging.debug('No video title to tag from in "' + path + '", leaving it as it is')
+                    checked.append((path, ('', None), ''))
+                    skipped += 1
+                    continue
+
+                source = current['comment'], current.get('channel')
+            tags = get_retag_tags(source[0], channels, source[1], title_parser)
+        except (MutagenError, OSError, ValueError):
+            logging.exception('Could not read tags of "' + path + '"')
+            failed += 1
+            continue
+
+        # Only files whose tags are different from what they should be are written to,
+        # that includes fields the file has but shouldn't have anymore
+        if current is None or any(
+            current.get(tag.fieldname) != (tag.value if tagging.has_value(tag) else None)
+            for tag in tags
+        ):
+            writes.append((path, tags, None))
+        checked.append((path, source, hash_tags(tags)))
+
+    not_written = set(tagging.apply_tags_to_files(writes))
+
+    entries = []
+    for path, source, tag_hash in checked:
+        if path in not_written:
+            continue
+        try:
+            entries.append((path, os.stat(path).st_mtime, source[0], source[1], tag_hash))
+        except OSError:
+            pass
 
-    # Declare header with authorization info
-    header = {'Authorization': (oauth.credentials['token_type'] + ' ' + oauth.credentials['access_token'])}
+    return entries, len(writes) - len(not_written), skipped, failed + len(not_written)
 
-    # Declare parameters for request
-    params = {'id': pi_id}
 
-    # Encode and parse parameters into URL
-    params = urllib.parse.urlencode(params)
-    full_url = url + '?' + params
+def get_retag_tags(video_title, channels, channel, title_parser):
+    # Fields that no longer get a value are cleared, so a removed genre rule or title pattern is undone as well
+    # Without the channel there is no telling what the genre should be, so it is left as it is
+    fieldnames = ['title', 'artist', 'genre'] if channel else ['title', 'artist']
+    tags = [tag for tag in get_tags(video_title, channels, channel, title_parser) if tag.fieldname in fieldnames]
+    present = {tag.fieldname for tag in tags}
+    return tags + [tagging.Tag(fieldname, None) for fieldname in fieldnames if fieldname not in present]
 
-    # Create opener object
-    # TODO: Try without opener object
-    opener = urllib.request.build_opener(urllib.request.HTTPHandler)
 
-    # Create request object
-    req = urllib.request.Request(full_url)
+def hash_tags(tags):
+    # Short fingerprint of the tags a file should get, to tell whether a change in the config affects it
+    return hashlib.sha1(json.dumps([[tag.fieldname, tag.value] for tag in tags]).encode('utf-8')).hexdigest()[:16]
 
-    # Add authentication header
-    for k in header:
-        req.add_header(k, header[k])
 
-    # Set request method to DELETE
-    req.get_method = lambda: 'DELETE'
+def delete_playlist_item(client, playlist_item_id):
+    # Declare parameters for request, the unique id of the playlist item
+    params = {'id': playlist_item_id}
 
     try:
         # Get response from API request
-        opener.open(req)
-    except urllib.error.HTTPError as e:
-        if e.code == 401:
-            # Get a new access token
-            oauth.authorize_credentials()
-
-            # Update authorization header for request
-            req.remove_header('Authorization')
-            header = {'Authorization': (oauth.credentials['token_type'] + ' ' + oauth.credentials['access_token'])}
-            for k in header:
-                req.add_header(k, header[k])
-
-            # Retry request with new access token
-            try:
-                opener.open(req)
-            except urllib.error.HTTPError:
-                logging.exception('Received unexpected response from API server while deleting playlist item')
-                sys.exit()
-        else:
-            logging.exception('Received unexpected response from API server while deleting playlist item')
-            sys.exit()
+        with metrics.stage('delete'):
+            client.call('DELETE', 'playlistItems', params)
+    except api.HTTPError as e:
+        # If the item is already gone, there is nothing left to do
+        if e.code == 404:
+            logging.debug('Playlist item was already deleted')
+            return
+
+        # Let the caller decide whether to retry
+        logging.debug('Received unexpected response from API server while deleting playlist item')
+        raise
 
 
 def setup(client_id, client_secret, credentials_file):
@@ -478,11 +1273,38 @@ def init_args():
     parser = argparse.ArgumentParser(description='Automatically download and tag music from a YouTube playlist')
     parser.add_argument('-d', '--debug', action='store_true', help='Write debug info to stdout and log file')
     parser.add_argument('--setup', action='store_true', help='Perform first-time setup so that the program can run autonomously')
+    parser.add_argument('--daemon', action='store_true', help='Keep running and poll the playlist for new videos')
+    parser.add_argument('--retag', action='store_true', help='Tag the files already in the output directories again')
     return parser.parse_args()
 
 
+def acquire_locks(playlists):
+    available = []
+
+    for playlist in playlists:
+        # Playlist IDs can contain characters that don't belong in a filename, so use a hash
+        name = hashlib.sha1(playlist['id'].encode('utf-8')).hexdigest()[:16]
+        playlist_lock = lock.LockFile(os.path.join(LOCK_DIR, 'yt-music-dl-' + name + '.lock'))
+
+        try:
+            acquired = playlist_lock.acquire()
+        except PermissionError:
+            logging.exception('No permission to create lock file, make sure you are running as root')
+            sys.exit()
+
+        if acquired:
+            held_locks.append(playlist_lock)
+            available.append(playlist)
+        else:
+            logging.debug('Playlist {} is already being processed, skipping it'.format(playlist['id']))
+
+    return available
+
+
 def cleanup():
-    os.unlink(PID_FILE)
+    for playlist_lock in held_locks:
+        playlist_lock.release()
+    del held_locks[:]
 
 
 if __name__ == '__main__':